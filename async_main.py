@@ -1,7 +1,22 @@
 import argparse
 import asyncio
+import logging
 from async_server import AsyncServer
-from caching import Cache, CsvCacheManager
+from caching import Cache, SNAPSHOT_FORMATS, get_cache_manager
+from sharded_cache import ShardedCache
+from shared_cache import SharedTable, SharedCache
+from workers import WorkerSupervisor
+from snapshots import CacheJournal, Snapshotter
+from dns_structs import EDNS_PAYLOAD
+from metrics import StatsServer
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger(__name__)
+LOG_LEVELS = ['debug', 'info', 'warning', 'error']
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -9,26 +24,159 @@ parser.add_argument(
 parser.add_argument(
     '--save', required=True,
     help='name of file to save cache in')
+parser.add_argument(
+    '--max-entries', type=int,
+    help='maximum number of cached names, least recently used are evicted')
+parser.add_argument(
+    '--max-bytes', type=int,
+    help='approximate maximum size of cache in bytes')
+parser.add_argument(
+    '--shards', type=int, default=1,
+    help='number of parts of cache with their own locks')
+parser.add_argument(
+    '--edns-payload', type=int, default=EDNS_PAYLOAD, metavar='SIZE',
+    help='UDP payload size advertised with EDNS0, 0 disables EDNS0')
+parser.add_argument(
+    '--uvloop', action='store_true',
+    help='run on uvloop event loop')
+parser.add_argument(
+    '--snapshot-format', choices=sorted(SNAPSHOT_FORMATS), default='binary',
+    help='format of file to save cache in, format of loaded file is detected')
+parser.add_argument(
+    '--race', type=int, default=1, metavar='FANOUT',
+    help='query up to FANOUT nameservers in parallel if the fastest is late')
+parser.add_argument(
+    '--max-active', type=int, default=1000, metavar='QUERIES',
+    help='maximum number of client queries resolved at once, '
+        'queries over it are answered only from cache')
+parser.add_argument(
+    '--max-upstream', type=int, default=1000, metavar='QUERIES',
+    help='maximum number of queries to nameservers at once')
+parser.add_argument(
+    '--overload', choices=['servfail', 'refused', 'drop'], default='servfail',
+    help='how to answer queries shed under overload')
+parser.add_argument(
+    '--prefetch', type=int, default=0, metavar='PARALLEL',
+    help='refresh popular records close to expiry, up to PARALLEL at once')
+parser.add_argument(
+    '--stale-window', type=float, default=0, metavar='SECONDS',
+    help='keep expired records for SECONDS to answer them '
+        'if nameservers are late or fail')
+parser.add_argument(
+    '--workers', type=int, default=1,
+    help='number of worker processes sharing the port with SO_REUSEPORT')
+parser.add_argument(
+    '--shared-cache', type=int, metavar='SLOTS',
+    help='keep records in shared memory table of SLOTS names, used by all workers')
+parser.add_argument(
+    '--snapshot-interval', type=float, metavar='SECONDS',
+    help='save cache in background every SECONDS')
+parser.add_argument(
+    '--journal',
+    help='name of file to log records cached since the last save in, '
+        'replayed on start')
+parser.add_argument(
+    '--stats-port', type=int, metavar='PORT',
+    help='serve metrics in Prometheus text format over HTTP on 127.0.0.1:PORT')
+parser.add_argument(
+    '--log-level', choices=LOG_LEVELS, default='warning',
+    help='log messages of that level and above, debug logs every query')
 
 
-def main():
-    loop = asyncio.get_event_loop()
+def make_cache(args, table=None):
+    if table is not None:
+        return SharedCache(table, args.max_entries, args.max_bytes, args.stale_window)
+    if args.shards > 1:
+        return ShardedCache(args.shards, args.max_entries, args.max_bytes, args.stale_window)
+    return Cache(args.max_entries, args.max_bytes, args.stale_window)
 
-    args = parser.parse_args()
+
+def load_cache(args, table=None, part_files=()):
+    cache = make_cache(args, table)
     if args.load:
-        cache = CsvCacheManager.load_cache_from(args.load)
-    else:
-        cache = Cache()
+        get_cache_manager(args.load).load_cache_from(args.load, cache)
+    # caches saved by worker before, newer than --load
+    for part_file in part_files:
+        get_cache_manager(part_file).load_cache_from(part_file, cache)
+    if args.journal:
+        CacheJournal.replay(args.journal, cache)
+    return cache
 
-    server = AsyncServer(loop, cache)
+
+def serve(args, save, reuse_port=False, cache=None):
+    loop = uvloop.new_event_loop() if args.uvloop else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    if cache is None:
+        cache = load_cache(args)
+    server = AsyncServer(loop, cache, args.race, reuse_port, args.edns_payload or None,
+        args.max_active, args.max_upstream, args.overload, args.prefetch)
+    stats_server = None
+    if args.stats_port:
+        stats_server = StatsServer(server.metrics, args.stats_port)
+        stats_server.start()
+    snapshotter = None
+    if save is not None:
+        if args.journal:
+            cache.journal = CacheJournal(args.journal)
+        snapshotter = Snapshotter(cache, save, SNAPSHOT_FORMATS[args.snapshot_format],
+            args.snapshot_interval, cache.journal)
+        snapshotter.start()
     try:
         loop.create_task(server.run())
         loop.run_forever()
         #loop.run_until_complete(server.run())
     except KeyboardInterrupt:
-        print('Server shutdown')
+        logger.info('Server shutdown')
+        logger.info('Server stats %s', server.stats())
     finally:
-        CsvCacheManager.save_cache_to(server.cache, args.save)
+        if stats_server is not None:
+            stats_server.stop()
+        if snapshotter is not None:
+            snapshotter.stop()
+            snapshotter.snapshot()
+        if cache.journal is not None:
+            cache.journal.close()
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if args.uvloop and uvloop is None:
+        parser.error('--uvloop requires uvloop to be installed')
+    if args.journal and args.workers > 1:
+        parser.error('--journal is supported with one worker only')
+    if args.stats_port and args.workers > 1:
+        parser.error('--stats-port is supported with one worker only')
+    table = None
+    if args.shared_cache:
+        # created and loaded once, before workers are forked
+        table = SharedTable(args.shared_cache)
+        load_cache(args, table)
+
+    if args.workers > 1 and table is not None:
+        # supervisor saves shared table itself
+        supervisor = WorkerSupervisor(
+            args.workers,
+            lambda save, part_files: serve(args, None, True, make_cache(args, table)),
+            lambda: make_cache(args, table),
+            args.save, SNAPSHOT_FORMATS[args.snapshot_format])
+        snapshotter = Snapshotter(make_cache(args, table), args.save,
+            SNAPSHOT_FORMATS[args.snapshot_format], args.snapshot_interval)
+        snapshotter.start()
+        supervisor.run()
+        snapshotter.stop()
+    elif args.workers > 1:
+        supervisor = WorkerSupervisor(
+            args.workers,
+            lambda save, part_files: serve(
+                args, save, True, load_cache(args, part_files=part_files)),
+            lambda: make_cache(args),
+            args.save, SNAPSHOT_FORMATS[args.snapshot_format])
+        supervisor.run()
+    else:
+        serve(args, args.save, cache=make_cache(args, table) if table else None)
     
        
 if __name__ == "__main__":
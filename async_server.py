@@ -1,159 +1,460 @@
-import struct
 import socket
 import asyncio
+import logging
 import random
-from dns_structs import (DNSPackage, Question,
-     construct_query_from_questions,
-     construct_response_from_answers,
-     get_parent_domain)
-from package_decode import decode_package
-from common import types, classes
+import time
+from dns_structs import (DNSPackage, Question, Resolution,
+     MAX_PACKAGE_SIZE, RDLEN, EDNS_PAYLOAD,
+     get_negative_soa,
+     construct_response_from_answers)
+from package_decode import (decode_package_lazy, fit_response, fit_udp_response,
+     DECODE_ERRORS)
+from common import types, classes, rcodes
 from caching import Cache, CsvCacheManager
-from async_socket import AsyncSocket
+from wire_cache import WireCache, get_max_bytes
+from upstream import UpstreamPool
+from prefetch import Prefetcher
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
 
 
 def log_rrs(rrs):
     for rr in rrs:
-        print(rr.__dict__)
+        logger.debug('%s %s %s %s %s', rr.name, rr.tp, rr.cl, rr.ttl, rr.data)
 
 ADDR = '127.0.0.1'
 PORT = 53
 ROOT = '198.41.0.4'
 
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.handle_datagram(data, addr)
+
+    def error_received(self, exc):
+        logger.warning('Server socket error %s', exc)
+
+
 class AsyncServer:
-    def __init__(self, loop, cache):
-        self.server_sock = None
+    # rcode of response to query shed under overload, None drops it
+    OVERLOAD_POLICIES = {
+        'servfail': rcodes['SERVFAIL'],
+        'refused': rcodes['REFUSED'],
+        'drop': None,
+    }
+    # glueless nameservers resolved at once
+    GLUELESS_PARALLEL = 3
+    # idle client TCP connections are closed after that many seconds (RFC 7766)
+    TCP_IDLE_TIMEOUT = 10
+    # queries of one TCP connection resolved at once
+    TCP_PIPELINE = 32
+    # client response timer, stale records are answered if resolution
+    # takes longer (RFC 8767)
+    STALE_ANSWER_TIMEOUT = 1.8
+    # resolutions taking longer end with SERVFAIL, so questions waiting for
+    # each other through glueless nameservers do not wait forever
+    RESOLUTION_TIMEOUT = 10
+
+    def __init__(self, loop, cache, race_fanout=1, reuse_port=False,
+            edns_payload=EDNS_PAYLOAD, max_active=None, max_upstream=None,
+            overload_policy='servfail', prefetch=0, metrics=None):
+        self.transport = None
+        self.tcp_server = None
+        # lets several worker processes listen on the same port
+        self.reuse_port = reuse_port
         self.loop = loop
         self.cache = cache
+        # UDP payload accepted from clients and servers, None disables EDNS0
+        self.edns_payload = edns_payload
+        self.metrics = Metrics() if metrics is None else metrics
+        self.upstream = UpstreamPool(loop, fanout=race_fanout, edns_payload=edns_payload,
+            max_queries=max_upstream, metrics=self.metrics)
+        self.wire_cache = WireCache(cache.max_entries, get_max_bytes(cache.max_bytes))
+        # (name, tp, cl) -> task resolving it from upstream
+        self.pending_resolutions = dict()
+        self.upstream_resolutions = 0
+        self.coalesced_queries = 0
+        # questions answered with stale records of cache
+        self.stale_answers = 0
+        # client queries being resolved, and limit of them
+        self.active_queries = 0
+        self.max_active = max_active
+        self.overload_rcode = AsyncServer.OVERLOAD_POLICIES[overload_policy]
+        self.shed_queries = 0
+        # refreshes popular records before expiry, up to prefetch at once
+        self.prefetcher = None
+        if prefetch > 0:
+            self.prefetcher = Prefetcher(loop, self.prefetch, prefetch)
+            self.cache.on_expiring = self.prefetcher.on_expiring
+            self.wire_cache.on_expiring = self.prefetcher.on_expiring
+        self.metrics.add_stats('dns_server', self.stats)
+        self.metrics.add_stats('dns_cache', self.cache.stats)
+
+    def stats(self):
+        return {
+            'active_queries': self.active_queries,
+            'shed_queries': self.shed_queries,
+            'pending_resolutions': len(self.pending_resolutions),
+            'upstream_resolutions': self.upstream_resolutions,
+            'coalesced_queries': self.coalesced_queries,
+            'upstream_active_queries': self.upstream.active_queries,
+            'upstream_shed_queries': self.upstream.shed_queries,
+            'prefetches': 0 if self.prefetcher is None else self.prefetcher.prefetches,
+            'stale_answers': self.stale_answers,
+        }
 
     async def run(self):
-        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_sock.bind((ADDR, PORT))
-        self.server_sock.setblocking(False)
-        self.server_sock = AsyncSocket(self.loop, self.server_sock)
-
-        print('DNS server listening on {0}:{1}'.format(ADDR, PORT))
+        # upstream sockets are ready before the first query comes
+        await self.upstream.start()
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.reuse_port:
+            server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_sock.bind((ADDR, PORT))
+        server_sock.setblocking(False)
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: ServerProtocol(self), sock=server_sock)
+        self.tcp_server = await asyncio.start_server(
+            self.serve_tcp_client, ADDR, PORT, reuse_port=self.reuse_port)
+
+        logger.info('DNS server listening on %s:%s', ADDR, PORT)
 
         while True:
-            client_task = self.server_sock.recvfrom(1024)
             # required for proper signal propagation on Windows
-            timeout_task = asyncio.sleep(2) 
-            done, pending = await asyncio.wait(
-                [client_task, timeout_task], 
-                return_when=asyncio.FIRST_COMPLETED)
-            
-            if client_task in done:
-                byte_query, client_addr = client_task.result()
-                self.loop.create_task(self.serve_client(byte_query, client_addr))
-            else:
-                client_task.cancel()
-
-    async def serve_client(self, byte_query, client_addr):
-        print('Query from {0}:{1}'.format(*client_addr))
-        parsed_query = decode_package(byte_query)
-
-        await self.process_query(parsed_query, client_addr)
-
-    async def process_query(self, query, client_addr):
+            await asyncio.sleep(2)
+
+    def handle_datagram(self, byte_query, client_addr):
+        received_at = time.monotonic()
+        logger.debug('Query from %s:%s', *client_addr)
+        self.metrics.queries.inc('udp')
+        try:
+            query = decode_package_lazy(byte_query)
+            # malformed queries are dropped here, not in resolution task,
+            # additions are decoded for payload of OPT record
+            query.questions
+            query.additions
+        except DECODE_ERRORS:
+            return
+
+        # cached responses are sent right away, without task
+        byte_response = self.find_cached_response(query)
+        if byte_response is None and self.admit(query):
+            self.active_queries += 1
+            self.loop.create_task(self.serve_client(query, client_addr, received_at))
+            return
+        if byte_response is None:
+            byte_response = self.shed_query(query)
+        if byte_response is not None:
+            self.transport.sendto(
+                fit_udp_response(byte_response, query.edns_payload, self.edns_payload),
+                client_addr)
+            self.metrics.count_response(byte_response, received_at, time.monotonic())
+
+    async def serve_client(self, query, client_addr, received_at):
+        try:
+            byte_response = await self.process_query(query)
+        finally:
+            self.active_queries -= 1
+        self.transport.sendto(
+            fit_udp_response(byte_response, query.edns_payload, self.edns_payload),
+            client_addr)
+        self.metrics.count_response(byte_response, received_at, time.monotonic())
+
+    def find_cached_response(self, query):
+        if len(query.questions) != 1:
+            return None
+        byte_response = self.wire_cache.find_response(query.id, query.questions[0])
+        if byte_response is not None:
+            logger.debug('resolved from wire cache')
+            self.metrics.cache_hits.inc('wire')
+        return byte_response
+
+    def admit(self, query):
+        # under overload only queries answered from cache are resolved
+        if self.max_active is None or self.active_queries < self.max_active:
+            return True
+        return all(
+            len(self.cache.find_answers(question)) > 0
+            or self.cache.find_negative(question) is not None
+            for question in query.questions)
+
+    def shed_query(self, query):
+        # response to query refused under overload, None if it is dropped
+        self.shed_queries += 1
+        if self.overload_rcode is None:
+            return None
+        return construct_response_from_answers(query.id, [], self.overload_rcode).to_bytes()
+
+    async def serve_tcp_client(self, reader, writer):
+        # queries of connection are resolved concurrently
+        # and answered in order of resolution
+        logger.debug('TCP connection from %s:%s', *writer.get_extra_info('peername')[:2])
+        tasks = set()
+        try:
+            while True:
+                try:
+                    length = await asyncio.wait_for(
+                        reader.readexactly(2), AsyncServer.TCP_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if len(tasks) == 0:
+                        break
+                    continue
+                byte_query = await asyncio.wait_for(
+                    reader.readexactly(RDLEN.unpack(length)[0]), AsyncServer.TCP_IDLE_TIMEOUT)
+
+                if len(tasks) >= AsyncServer.TCP_PIPELINE:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                task = self.loop.create_task(self.serve_tcp_query(byte_query, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            # client may close its side after sending queries
+            if len(tasks) > 0:
+                await asyncio.wait(tasks)
+            writer.close()
+
+    async def serve_tcp_query(self, byte_query, writer):
+        received_at = time.monotonic()
+        self.metrics.queries.inc('tcp')
+        try:
+            query = decode_package_lazy(byte_query)
+            # malformed queries are dropped, the connection is kept
+            query.questions
+            query.additions
+        except DECODE_ERRORS:
+            return
+        byte_response = self.find_cached_response(query)
+        if byte_response is None and self.admit(query):
+            self.active_queries += 1
+            try:
+                byte_response = await self.process_query(query)
+            finally:
+                self.active_queries -= 1
+        elif byte_response is None:
+            byte_response = self.shed_query(query)
+            if byte_response is None:
+                return
+        if query.edns_payload is not None and self.edns_payload is not None:
+            byte_response = fit_response(byte_response, MAX_PACKAGE_SIZE, self.edns_payload)
+        if not writer.transport.is_closing():
+            writer.write(RDLEN.pack(len(byte_response)) + byte_response)
+            self.metrics.count_response(byte_response, received_at, time.monotonic())
+
+    async def process_query(self, query):
         tasks = [
-            self.process_question(question)
+            self.loop.create_task(self.process_question(question))
             for question in query.questions
         ]
 
         done, pending = await asyncio.wait(tasks)
         # smth like get results of all tasks and compose response
-        print('successfully resolved')
-        answers_to_send = []
-        for task in done:
-            answers_to_send += task.result()
+        logger.debug('successfully resolved')
+        return self.encode_response(
+            query.id, query.questions, [task.result() for task in done])
 
-        dns_response = construct_response_from_answers(query.id, answers_to_send)
-        self.server_sock.sendto(dns_response.to_bytes(), client_addr) 
-
-    async def process_question(self, question):
-        print('Question is {}'.format(question.__dict__))
+    def encode_response(self, query_id, questions, resolutions):
+        answers_to_send = []
+        authorities_to_send = []
+        rcode = rcodes['NOERROR']
+        stale = False
+        for resolution in resolutions:
+            answers_to_send += resolution.answers
+            authorities_to_send += resolution.authorities
+            stale = stale or resolution.stale
+            if rcode == rcodes['NOERROR']:
+                rcode = resolution.rcode
+
+        dns_response = construct_response_from_answers(
+            query_id, answers_to_send, rcode, authorities_to_send)
+        byte_response = dns_response.to_bytes()
+        if (len(questions) == 1 and rcode != rcodes['SERVFAIL'] and not stale
+                and len(answers_to_send) + len(authorities_to_send) > 0):
+            self.wire_cache.add_response(questions[0], byte_response)
+        return byte_response
+
+    async def prefetch(self, question):
+        # resolves question from upstream while it is still cached,
+        # clients asking it after expiry wait for the same resolution
+        key = (question.name, question.tp, question.cl)
+        if key in self.pending_resolutions:
+            return
+        resolution = await asyncio.shield(self._start_resolution(key, question))
+        if resolution.rcode != rcodes['SERVFAIL']:
+            self.encode_response(0, [question], [resolution])
+
+    async def process_question(self, question, resolving=()):
+        # resolving - keys of questions which resolution waits for this one
+        logger.debug('Question is %s %s %s', question.name, question.tp, question.cl)
         cached_answers = self.cache.find_answers(question)
 
         if len(cached_answers) > 0:
-            print('resolved from cache')
-            return cached_answers
-
-        ns_addr = self.find_nearest_ns(question.name)
-        answers = await self.get_answers_from_ns(ns_addr, question)
-        return answers
+            logger.debug('resolved from cache')
+            self.metrics.cache_hits.inc('records')
+            return Resolution(cached_answers)
+
+        negative = self.cache.find_negative(question)
+        if negative is not None:
+            logger.debug('resolved from negative cache')
+            self.metrics.cache_hits.inc('negative')
+            rcode, soa = negative
+            return Resolution([], rcode, [soa])
+
+        key = (question.name, question.tp, question.cl)
+        if key in resolving:
+            logger.debug('resolution loop')
+            return Resolution([], rcodes['SERVFAIL'])
+
+        self.metrics.cache_misses.inc()
+        resolution = self.pending_resolutions.get(key)
+        if resolution is not None:
+            # same question is being resolved already
+            self.coalesced_queries += 1
+        else:
+            resolution = self._start_resolution(key, question, resolving)
+
+        if self.cache.stale_window > 0 and len(resolving) == 0:
+            return await self.resolve_or_serve_stale(question, resolution)
+        return await asyncio.shield(resolution)
+
+    async def resolve_or_serve_stale(self, question, resolution):
+        # stale records answer client if resolution is late or fails,
+        # resolution goes on and refreshes cache
+        try:
+            result = await asyncio.wait_for(
+                asyncio.shield(resolution), AsyncServer.STALE_ANSWER_TIMEOUT)
+            if result.rcode != rcodes['SERVFAIL']:
+                return result
+        except asyncio.TimeoutError:
+            result = None
+
+        stale_answers = self.cache.find_stale_answers(question)
+        if len(stale_answers) == 0:
+            return result if result is not None else await asyncio.shield(resolution)
+        logger.debug('resolved from stale cache')
+        self.stale_answers += 1
+        self.metrics.cache_hits.inc('stale')
+        return Resolution(stale_answers, stale=True)
+
+    async def resolve_with_deadline(self, ns_addrs, question, resolving):
+        try:
+            return await asyncio.wait_for(
+                self.get_answers_from_ns(ns_addrs, question, resolving),
+                AsyncServer.RESOLUTION_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.debug('resolution timeout')
+            return Resolution([], rcodes['SERVFAIL'])
+
+    def _start_resolution(self, key, question, resolving=()):
+        ns_addrs = self.find_nearest_ns(question.name)
+        resolution = self.loop.create_task(
+            self.resolve_with_deadline(ns_addrs, question, resolving + (key,)))
+        self.pending_resolutions[key] = resolution
+        self.upstream_resolutions += 1
+        resolution.add_done_callback(
+            lambda _: self._finish_resolution(key, resolution))
+        return resolution
+
+    def _finish_resolution(self, key, resolution):
+        if self.pending_resolutions.get(key) is resolution:
+            del self.pending_resolutions[key]
 
     def find_nearest_ns(self, domain_name):
-        domain = get_parent_domain(domain_name)
-
-        while domain != '':
-            ns_q = Question(domain, types['NS'], 1)
-            auth_ns = self.cache.find_answers(ns_q)
-            if len(auth_ns) > 0:
-                for ans in auth_ns:
-                    addr_q = Question(ans.data, types['A'], 1)
-
-                    answers = self.cache.find_answers(addr_q)
-                    if len(answers) > 0:
-                        return answers[0].data
-            domain = get_parent_domain(domain)
-
-        print('use root')
-        return ROOT 
-
-    async def get_answers_from_ns(self, ns_addr, question):
-        # returns tuple: answers, authorities, additions
-        print('Question to ns is {}'.format(question.__dict__))
-        response = None
-
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock_to_ns:
-            sock_to_ns.setblocking(False)
-            sock_to_ns = AsyncSocket(self.loop, sock_to_ns)
-            #query_id = random.randrange(1, 2**16)
-            query_id = 1
-
-            query_to_ns = construct_query_from_questions(
-                query_id, [question])
-            sock_to_ns.sendto(query_to_ns.to_bytes(), (ns_addr, PORT))
-            response = await self.try_receive_response(sock_to_ns, question, query_id)
-
+        # addresses of nameservers of the nearest known zone
+        ns_addrs = self.cache.delegations.find_nearest(domain_name, time.monotonic())
+        if len(ns_addrs) > 0:
+            return ns_addrs
+
+        logger.debug('use root')
+        return [ROOT]
+
+    def find_ns_addresses(self, ns_names):
+        ns_addrs = []
+        for ns_name in ns_names:
+            addr_q = Question(ns_name, types['A'], 1)
+            ns_addrs += [answer.data for answer in self.cache.find_answers(addr_q)]
+        return ns_addrs
+
+    async def get_answers_from_ns(self, ns_addrs, question, resolving=()):
+        logger.debug('Question to ns is %s %s %s', question.name, question.tp, question.cl)
+        if len(ns_addrs) == 0:
+            return Resolution([], rcodes['SERVFAIL'])
+
+        response = await self.upstream.query_any(
+            [(ns_addr, PORT) for ns_addr in ns_addrs], question)
         if response is None:
-            return []
+            return Resolution([], rcodes['SERVFAIL'])
 
-        print('Got from ns {}'.format(ns_addr))
         answers, authorities, additions = self.process_response(response)
 
         if len(answers) != 0: 
             # ns answered
-            return answers
+            return Resolution(answers)
+
+        soa = get_negative_soa(authorities)
+        if response.rcode == rcodes['NXDOMAIN'] or len(soa) > 0:
+            # name or record of asked type does not exist
+            rcode = response.rcode
+            if rcode in (rcodes['NOERROR'], rcodes['NXDOMAIN']) and len(soa) > 0:
+                self.cache.add_negative(question, rcode, soa[0])
+            return Resolution([], rcode, soa[:1])
         
-        if len(authorities) > 0:
+        ns_names = [record.data for record in authorities if record.tp == types['NS']]
+        if len(ns_names) > 0:
             # there are some authorities to ask
-            next_ns_name = authorities[0].data
-            print('delegation to')
-            next_ns_ip = await self.resolve_ns_name(next_ns_name)
-            return await self.get_answers_from_ns(next_ns_ip, question)
+            logger.debug('delegation to')
+            next_ns_addrs = [
+                record.data for record in additions
+                if record.tp == types['A'] and record.name in ns_names]
+            if len(next_ns_addrs) == 0:
+                next_ns_addrs = self.find_ns_addresses(ns_names)
+            if len(next_ns_addrs) == 0:
+                next_ns_addrs = await self.resolve_ns_names(ns_names, resolving)
+            return await self.get_answers_from_ns(next_ns_addrs, question, resolving)
         
-        return []
+        return Resolution([], response.rcode)
+
+    async def resolve_ns_names(self, ns_names, resolving=()):
+        # resolves glueless nameservers concurrently, first resolved one wins
+        remained = list(ns_names)
+        tasks = set()
+        try:
+            while len(remained) > 0 or len(tasks) > 0:
+                while len(remained) > 0 and len(tasks) < AsyncServer.GLUELESS_PARALLEL:
+                    tasks.add(self.loop.create_task(
+                        self.resolve_ns_name(remained.pop(0), resolving)))
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if len(task.result()) > 0:
+                        return task.result()
+            return []
+        finally:
+            # resolutions themselves go on and get cached
+            for task in tasks:
+                task.cancel()
 
-    async def resolve_ns_name(self, ns_name):
+    async def resolve_ns_name(self, ns_name, resolving=()):
         question = Question(ns_name, types['A'], 1)
-        print('start resolving authority')
-        answers = await self.process_question(question)
-        a_answers = [
-            answer for answer in answers if answer.name == ns_name and answer.tp == types['A']
+        logger.debug('start resolving authority')
+        resolution = await self.process_question(question, resolving)
+        return [
+            answer.data for answer in resolution.answers
+            if answer.name == ns_name and answer.tp == types['A']
             ]
-        if len(a_answers) > 0:
-            return a_answers[0].data
-        return None
-
 
     def process_response(self, response):
-        print('{0} answers'.format(len(response.answers)))
-        log_rrs(response.answers)
-        print('{0} authorities'.format(len(response.authorities)))
-        log_rrs(response.authorities)
-        print('{0} additions'.format(len(response.additions)))
-        log_rrs(response.additions)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s answers', len(response.answers))
+            log_rrs(response.answers)
+            logger.debug('%s authorities', len(response.authorities))
+            log_rrs(response.authorities)
+            logger.debug('%s additions', len(response.additions))
+            log_rrs(response.additions)
 
         answers = list(self.filter_supported_records(response.answers))
         authorities = list(self.filter_supported_records(response.authorities))
@@ -166,16 +467,6 @@ class AsyncServer:
 
         return answers, authorities, additions
 
-    async def try_receive_response(self, sock_to_ns, question, query_id, attempts=10):
-        attempts = 10
-        while attempts > 0:
-            byte_response, source_ip = await sock_to_ns.recvfrom(1024)
-            response = decode_package(byte_response)
-            if response.id == query_id:
-                return response
-            attempts -= 1
-        return None
-
     def filter_supported_records(self, records):
         for record in records:
             if record.tp in types.values():
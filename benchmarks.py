@@ -0,0 +1,460 @@
+'''
+    Micro-benchmarks of server internals.
+
+    usage: benchmarks.py [-h] [--packets PACKETS] [--repeat REPEAT]
+                         [--entries ENTRIES] [--workers WORKERS] [--port PORT]
+                         [--window WINDOW] [--duration DURATION]
+                         bench
+
+    Captured packets are read from file as a sequence of packages,
+    each prefixed with 2-byte length (as in DNS over TCP).
+'''
+import argparse
+import asyncio
+import datetime
+import itertools
+import os
+import random
+import signal
+import socket
+import tempfile
+import struct
+import time
+import timeit
+import tracemalloc
+from threading import Lock, Thread
+from dns_structs import (Question, Answer,
+     construct_query_from_questions,
+     construct_response_from_answers)
+from package_decode import decode_package, decode_package_lazy, fit_udp_response
+from caching import Cache, CacheItem, SNAPSHOT_FORMATS
+from shared_cache import SharedTable, SharedCache
+from sharded_cache import ShardedCache
+import async_server
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+from common import types
+
+
+def load_packets(file_name):
+    packets = []
+    with open(file_name, 'rb') as capture:
+        data = capture.read()
+    offset = 0
+    while offset + 2 <= len(data):
+        length = struct.unpack('!H', data[offset:offset + 2])[0]
+        packets.append(data[offset + 2:offset + 2 + length])
+        offset += 2 + length
+    return packets
+
+
+def sample_packets():
+    question = Question('www.example.com.', types['A'], 1)
+    query = construct_query_from_questions(1, [question])
+
+    answer = construct_response_from_answers(1, [
+        Answer('www.example.com.', types['A'], 1, 300, '93.184.216.{}'.format(i))
+        for i in range(4)])
+    answer.qdcount = 1
+    answer.questions = [question]
+
+    referral = construct_response_from_answers(1, [])
+    referral.qdcount = 1
+    referral.questions = [question]
+    referral.authorities = [
+        Answer('com.', types['NS'], 1, 172800, '{}.gtld-servers.net.'.format(c))
+        for c in 'abcdefghijklm']
+    referral.additions = [
+        Answer('{}.gtld-servers.net.'.format(c), types['A'], 1, 172800,
+            '192.{}.{}.30'.format(5 + i, i))
+        for i, c in enumerate('abcdefghijklm')]
+    referral.nscount = len(referral.authorities)
+    referral.arcount = len(referral.additions)
+
+    return [query.to_bytes(), answer.to_bytes(), referral.to_bytes()]
+
+
+def bench_decode(args):
+    packets = load_packets(args.packets) if args.packets else sample_packets()
+    repeat = args.repeat
+
+    def eager():
+        for packet in packets:
+            decode_package(packet)
+
+    def lazy_header():
+        for packet in packets:
+            decode_package_lazy(packet).questions
+
+    def lazy_full():
+        for packet in packets:
+            decode_package_lazy(packet).additions
+
+    print('{0} packets, {1} rounds'.format(len(packets), repeat))
+    for name, func in [
+            ('eager decode_package', eager),
+            ('lazy, header + questions', lazy_header),
+            ('lazy, all sections', lazy_full)]:
+        seconds = min(timeit.repeat(func, number=repeat, repeat=3))
+        per_packet = seconds / (repeat * len(packets)) * 1e6
+        print('{0:<28} {1:8.2f} us/packet'.format(name, per_packet))
+
+
+class LegacyCacheItem:
+    # cache entry as it was before monotonic expiry times
+    def __init__(self, data, ttl):
+        self.data = data
+        self.ttl = ttl
+        self.cached_at = datetime.datetime.now()
+
+
+class LegacyCache:
+    def __init__(self):
+        self.cache = dict()
+        self.cache_lock = Lock()
+
+    def add_answer(self, answer):
+        key = (answer.name, answer.tp, answer.cl)
+        self.cache.setdefault(key, []).append(
+            LegacyCacheItem(answer.data, answer.ttl))
+
+    def find_answers(self, question):
+        with self.cache_lock:
+            key = (question.name, question.tp, question.cl)
+            if key in self.cache.keys():
+                alive_records = []
+                for record in self.cache[key]:
+                    expires_at = record.cached_at + datetime.timedelta(seconds=record.ttl)
+                    if datetime.datetime.now() < expires_at:
+                        alive_records.append(record)
+                result = [Answer(*(key + (record.ttl, record.data)))
+                    for record in alive_records]
+                self.cache[key] = alive_records
+                return result
+            return []
+
+
+def bench_cache(args):
+    answers = [
+        Answer('host{}.example.com.'.format(i), types['A'], 1, 3600,
+            '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255))
+        for i in range(args.entries)]
+    questions = [Question(answer.name, answer.tp, answer.cl) for answer in answers]
+
+    print('{0} entries, {1} lookups'.format(args.entries, args.repeat))
+    for name, cache_class in [('before (datetime)', LegacyCache), ('after (monotonic)', Cache)]:
+        tracemalloc.start()
+        cache = cache_class()
+        for answer in answers:
+            cache.add_answer(answer)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        lookups = [questions[i % len(questions)] for i in range(args.repeat)]
+        started = time.perf_counter()
+        for question in lookups:
+            cache.find_answers(question)
+        elapsed = time.perf_counter() - started
+
+        print('{0:<20} {1:8.1f} bytes/entry {2:12.0f} lookups/sec'.format(
+            name, memory / args.entries, args.repeat / elapsed))
+
+    for name, make_item in [
+            ('before (datetime)', lambda answer: LegacyCacheItem(answer.data, answer.ttl)),
+            ('after (monotonic)', lambda answer: CacheItem(answer.data, answer.ttl, 0.0))]:
+        tracemalloc.start()
+        items = [make_item(answer) for answer in answers]
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del items
+        print('{0:<20} {1:8.1f} bytes/item'.format(name, memory / args.entries))
+
+
+def rss_anon_kb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1])
+    return 0
+
+
+def bench_shared(args):
+    # workers look up names with Zipf popularity and cache the missed ones
+    answers = [
+        Answer('host{}.example.com.'.format(i), types['A'], 1, 3600,
+            '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255))
+        for i in range(args.entries)]
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, args.entries + 1)))
+
+    def work(index, cache):
+        rnd = random.Random(index)
+        memory_kb = rss_anon_kb()
+        hits = 0
+        for answer in rnd.choices(answers, cum_weights=cum_weights, k=args.repeat):
+            if len(cache.find_answers(answer)) > 0:
+                hits += 1
+            else:
+                cache.add_answer(answer)
+        return hits, rss_anon_kb() - memory_kb
+
+    print('{0} names, {1} workers, {2} lookups each'.format(
+        args.entries, args.workers, args.repeat))
+    for name, make_cache in [
+            ('private', lambda table: Cache()),
+            ('shared', lambda table: SharedCache(table))]:
+        table = SharedTable(args.entries) if name == 'shared' else None
+        pids = []
+        for index in range(args.workers):
+            read_end, write_end = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_end)
+                result = work(index, make_cache(table))
+                os.write(write_end, struct.pack('!QQ', *result))
+                os._exit(0)
+            os.close(write_end)
+            pids.append((pid, read_end))
+
+        hits = 0
+        memory_kb = table.size // 1024 if table is not None else 0
+        for pid, read_end in pids:
+            worker_hits, worker_memory_kb = struct.unpack('!QQ', os.read(read_end, 16))
+            os.close(read_end)
+            os.waitpid(pid, 0)
+            hits += worker_hits
+            memory_kb += worker_memory_kb
+
+        print('{0:<10} {1:6.1%} hit ratio {2:10d} KiB memory for cache'.format(
+            name, hits / (args.workers * args.repeat), memory_kb))
+
+
+def bench_snapshot(args):
+    cache = Cache()
+    for i in range(args.entries):
+        name = 'host{}.example.com.'.format(i)
+        cache.add_answer(Answer(name, types['A'], 1, 3600, '10.0.{}.{}'.format(i >> 8 & 255, i & 255)))
+        cache.add_answer(Answer(name, types['NS'], 1, 3600, 'ns{}.example.com.'.format(i % 4)))
+
+    print('{0} names, {1} records'.format(args.entries, 2 * args.entries))
+    with tempfile.TemporaryDirectory() as directory:
+        for name in sorted(SNAPSHOT_FORMATS):
+            manager = SNAPSHOT_FORMATS[name]
+            file_name = os.path.join(directory, name)
+            started = time.perf_counter()
+            manager.save_cache_to(cache, file_name)
+            saved = time.perf_counter()
+            manager.load_cache_from(file_name, Cache())
+            loaded = time.perf_counter()
+            print('{0:<8} {1:8.2f} s save {2:8.2f} s load {3:10d} bytes'.format(
+                name, saved - started, loaded - saved, os.path.getsize(file_name)))
+
+
+def bench_threads(args):
+    # threads look up random names, every tenth lookup is followed by adding record,
+    # while another thread copies records for snapshots over and over
+    answers = [
+        Answer('host{}.example.com.'.format(i), types['A'], 1, 3600,
+            '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255))
+        for i in range(args.entries)]
+    questions = [Question(answer.name, answer.tp, answer.cl) for answer in answers]
+
+    def work(index, cache, worst):
+        rnd = random.Random(index)
+        for i in range(args.repeat):
+            j = rnd.randrange(len(questions))
+            started = time.perf_counter()
+            cache.find_answers(questions[j])
+            worst[index] = max(worst[index], time.perf_counter() - started)
+            if i % 10 == 0:
+                cache.add_answer(answers[j])
+
+    def snapshot(cache, running):
+        while running:
+            for record in cache.get_records():
+                pass
+
+    print('{0} entries, {1} lookups per thread'.format(args.entries, args.repeat))
+    for name, make_cache in [('one lock', Cache), ('sharded', ShardedCache)]:
+        cache = make_cache()
+        for answer in answers:
+            cache.add_answer(answer)
+
+        threads_count = 1
+        while threads_count <= args.workers:
+            worst = [0.0] * threads_count
+            running = [True]
+            snapshot_thread = Thread(target=snapshot, args=(cache, running))
+            threads = [
+                Thread(target=work, args=(index, cache, worst))
+                for index in range(threads_count)]
+            snapshot_thread.start()
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            running.clear()
+            snapshot_thread.join()
+            print('{0:<10} {1:3d} threads {2:12.0f} lookups/sec {3:8.1f} ms worst lookup'.format(
+                name, threads_count, threads_count * args.repeat / elapsed, max(worst) * 1e3))
+            threads_count *= 2
+
+
+class LegacyAsyncSocket:
+    # listener socket as it was, reader is registered for every blocked recvfrom
+    def __init__(self, loop, sock):
+        self.loop = loop
+        self.sock = sock
+
+    def recvfrom(self, n_bytes, fut=None, registed=False):
+        fd = self.sock.fileno()
+        if fut is None:
+            fut = self.loop.create_future()
+        if registed:
+            self.loop.remove_reader(fd)
+
+        try:
+            data, addr = self.sock.recvfrom(n_bytes)
+        except (BlockingIOError, InterruptedError):
+            self.loop.add_reader(fd, self.recvfrom, n_bytes, fut, True)
+        else:
+            fut.set_result((data, addr))
+        return fut
+
+
+async def legacy_run(server):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((async_server.ADDR, async_server.PORT))
+    sock.setblocking(False)
+    server_sock = LegacyAsyncSocket(server.loop, sock)
+
+    async def serve_client(byte_query, client_addr):
+        print('Query from {0}:{1}'.format(*client_addr))
+        query = decode_package_lazy(byte_query)
+        byte_response = server.wire_cache.find_response(query.id, query.questions[0])
+        print('resolved from wire cache')
+        sock.sendto(
+            fit_udp_response(byte_response, query.edns_payload, server.edns_payload),
+            client_addr)
+
+    while True:
+        client_task = server_sock.recvfrom(1024)
+        timeout_task = server.loop.create_task(asyncio.sleep(2))
+        done, pending = await asyncio.wait(
+            [client_task, timeout_task], return_when=asyncio.FIRST_COMPLETED)
+        if client_task in done:
+            byte_query, client_addr = client_task.result()
+            server.loop.create_task(serve_client(byte_query, client_addr))
+        else:
+            client_task.cancel()
+
+
+def serve_wire_cached(make_loop, run):
+    # server answering the only question from wire cache, output is muted
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    loop = make_loop()
+    asyncio.set_event_loop(loop)
+    server = async_server.AsyncServer(loop, Cache())
+    question = Question('www.example.com.', types['A'], 1)
+    response = construct_response_from_answers(0, [
+        Answer(question.name, question.tp, question.cl, 3600, '93.184.216.34')])
+    response.qdcount = 1
+    response.questions = [question]
+    server.wire_cache.add_response(question, response.to_bytes())
+    loop.run_until_complete(run(server))
+
+
+def count_responses(port, window, duration):
+    # keeps window of queries in flight, lost ones are sent again on timeout
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    query = construct_query_from_questions(
+        1, [Question('www.example.com.', types['A'], 1)]).to_bytes()
+    addr = (async_server.ADDR, port)
+    for i in range(window):
+        sock.sendto(query, addr)
+
+    responses = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        try:
+            sock.recvfrom(4096)
+            responses += 1
+        except socket.timeout:
+            for i in range(window):
+                sock.sendto(query, addr)
+            continue
+        sock.sendto(query, addr)
+    sock.close()
+    return responses
+
+
+def bench_qps(args):
+    async_server.PORT = args.port
+    loops = [
+        ('before (AsyncSocket)', asyncio.new_event_loop, legacy_run),
+        ('after (protocol)', asyncio.new_event_loop, lambda server: server.run())]
+    if uvloop is not None:
+        loops.append(('after (uvloop)', uvloop.new_event_loop, lambda server: server.run()))
+
+    print('{0} queries in flight, {1} s each'.format(args.window, args.duration))
+    for name, make_loop, run in loops:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve_wire_cached(make_loop, run)
+            finally:
+                os._exit(0)
+
+        time.sleep(0.5)
+        responses = count_responses(args.port, args.window, args.duration)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        print('{0:<22} {1:10.0f} queries/sec'.format(name, responses / args.duration))
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'cache': bench_cache,
+    'shared': bench_shared,
+    'snapshot': bench_snapshot,
+    'threads': bench_threads,
+    'qps': bench_qps,
+}
+
+parser = argparse.ArgumentParser()
+parser.add_argument('bench', choices=sorted(BENCHMARKS))
+parser.add_argument(
+    '--packets', help='file with captured packets')
+parser.add_argument(
+    '--repeat', type=int, default=10000,
+    help='number of rounds')
+parser.add_argument(
+    '--entries', type=int, default=100000,
+    help='number of cache entries')
+parser.add_argument(
+    '--workers', type=int, default=4,
+    help='number of worker processes, or maximum number of threads')
+parser.add_argument(
+    '--port', type=int, default=5399,
+    help='port of server under load')
+parser.add_argument(
+    '--window', type=int, default=32,
+    help='number of queries in flight')
+parser.add_argument(
+    '--duration', type=float, default=5,
+    help='seconds of load')
+
+
+def main():
+    args = parser.parse_args()
+    BENCHMARKS[args.bench](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,20 @@
 import datetime
 import functools 
-from dns_structs import Answer, Question
+import gc
+import heapq
+import itertools
+import mmap
+import os
+import socket
+import struct
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from dns_structs import (Answer, Question, get_soa_minimum,
+     pack_data, unpack_data, rdata_to_bytes, rdata_from_bytes)
+from common import rcodes, types
+from delegation import DelegationIndex
 from csv import DictReader, DictWriter
 from threading import Lock
 
@@ -15,97 +29,508 @@ def synchronized(lock=None):
     return decorator
 
 
+# records hit in that last part of their TTL are reported as expiring
+EXPIRING_FRACTION = 0.1
+# ttl of expired records answered in serve-stale mode (RFC 8767)
+STALE_TTL = 30
+
+
 class CacheItem:
-    def __init__(self, data, ttl, cached_at=None):
+    __slots__ = ('data', 'ttl', 'expires_at')
+
+    def __init__(self, data, ttl, expires_at):
+        # rdata, packed address for A and AAAA records
         self.data = data
+        # original ttl, expires_at is time.monotonic() based
         self.ttl = ttl
+        self.expires_at = expires_at
 
-        if cached_at is not None:
-            self.cached_at = cached_at
-        else:
-            self.cached_at = datetime.datetime.now()
+
+class NegativeItem:
+    __slots__ = ('rcode', 'soa', 'expires_at')
+
+    def __init__(self, rcode, soa, expires_at):
+        self.rcode = rcode
+        self.soa = soa
+        self.expires_at = expires_at
 
 
 class Cache:
-    def __init__(self):
-        self.cache = dict()
+    # rough size of key, item and list bookkeeping, used for max_bytes
+    ITEM_OVERHEAD = 200
+
+    def __init__(self, max_entries=None, max_bytes=None, stale_window=0):
+        # keys are kept in least recently used order
+        self.cache = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # seconds expired records are kept for to be answered if upstream fails
+        self.stale_window = stale_window
+        # (expires_at, key) for proactive removal of expired records
+        self.expiry_heap = []
+        # NXDOMAIN and NODATA answers (RFC 2308), NXDOMAIN keys have tp None
+        self.negative_cache = OrderedDict()
+        self.negative_expiry_heap = []
+        # zone cuts of cached NS records
+        self.delegations = DelegationIndex()
+        # CacheJournal logging added records between snapshots
+        self.journal = None
+        # called with key and its hits when record is hit close to expiry
+        self.on_expiring = None
+        # key -> number of hits, counted while on_expiring is set
+        self.hits = dict()
+
+        self.size_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
         self.cache_lock = Lock()
         self.add_answer = synchronized(self.cache_lock)(self.add_answer)
         self.find_answers = synchronized(self.cache_lock)(self.find_answers)
+        self.find_stale_answers = synchronized(self.cache_lock)(self.find_stale_answers)
+        self.add_negative = synchronized(self.cache_lock)(self.add_negative)
+        self.find_negative = synchronized(self.cache_lock)(self.find_negative)
+
+    def stats(self):
+        return {
+            'entries': len(self.cache),
+            'negative_entries': len(self.negative_cache),
+            'bytes': self.size_bytes,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
 
-    def add_answer(self, answer, cached_at=None):
+    def add_answer(self, answer, expires_at=None):
         key = (answer.name, answer.tp, answer.cl)
-        if key not in self.cache.keys():
-            self.cache[key] = []
-            
-        new_item = CacheItem(answer.data, answer.ttl, cached_at)
-        for i in range(len(self.cache[key])):
-            item = self.cache[key][i]
-            if item.data == new_item.data and new_item.cached_at > item.cached_at:
-                self.cache[key][i] = new_item
+        now = time.monotonic()
+        self._remove_expired(now)
+
+        records = self.cache.get(key)
+        if records is None:
+            records = []
+        else:
+            self.cache.move_to_end(key)
+
+        if expires_at is None:
+            expires_at = now + answer.ttl
+        self._index_delegation(answer.name, answer.tp, answer.rdata, expires_at)
+        if self.journal is not None:
+            self.journal.append(answer, expires_at)
+
+        # lists of records are replaced, not changed in place,
+        # so they can be read without lock
+        new_item = CacheItem(answer.rdata, answer.ttl, expires_at)
+        for i in range(len(records)):
+            item = records[i]
+            if item.data == new_item.data:
+                if new_item.expires_at > item.expires_at:
+                    records = list(records)
+                    records[i] = new_item
+                    self.cache[key] = records
+                    heapq.heappush(self.expiry_heap, (new_item.expires_at, key))
                 return
-                
-        self.cache[key].append(CacheItem(answer.data, answer.ttl, cached_at))
+
+        self.cache[key] = records + [new_item]
+        self.size_bytes += self._item_size(key, new_item)
+        heapq.heappush(self.expiry_heap, (new_item.expires_at, key))
+        self._evict()
+
+    def load_records(self, records):
+        # bulk insertion of (key, items) pairs, without linear search per record
+        with self.cache_lock:
+            now = time.monotonic()
+            self._remove_expired(now)
+            loaded = []
+            for key, items in records:
+                old_items = self.cache.get(key)
+                if old_items is not None or len(items) > 1:
+                    items = self._merge_items(old_items or [], items, now)
+                elif items[0].expires_at + self.stale_window <= now:
+                    continue
+                if len(items) == 0:
+                    continue
+
+                if old_items is not None:
+                    for item in old_items:
+                        self.size_bytes -= self._item_size(key, item)
+                    self.cache.move_to_end(key)
+                self.cache[key] = items
+                for item in items:
+                    self.size_bytes += self._item_size(key, item)
+                self.expiry_heap.append((min(item.expires_at for item in items), key))
+                loaded.append((key, items))
+
+            # addresses are indexed only for already known nameservers
+            for tp in (types['NS'], types['A']):
+                for key, items in loaded:
+                    if key[1] == tp:
+                        for item in items:
+                            self._index_delegation(key[0], tp, item.data, item.expires_at)
+
+            heapq.heapify(self.expiry_heap)
+            self._evict()
+
+    def _merge_items(self, old_items, items, now):
+        # alive items with distinct data, latest expiring ones are kept
+        merged = dict()
+        for item in itertools.chain(old_items, items):
+            current = merged.get(item.data)
+            if now < item.expires_at + self.stale_window and (
+                    current is None or item.expires_at > current.expires_at):
+                merged[item.data] = item
+        return list(merged.values())
+
+    def get_records(self):
+        # copy of (key, records) pairs to iterate without holding the lock
+        with self.cache_lock:
+            return [(key, list(records)) for key, records in self.cache.items()]
 
     def find_answers(self, question):
         key = (question.name, question.tp, question.cl)
-        if key in self.cache.keys():
-            records = self.cache[key]
-            alive_records = self._get_alive_records(records)
-            result = [Answer(*(key + (record.ttl, record.data)))
-                for record in alive_records]
+        records = self.cache.get(key)
+        if records is None:
+            return []
+
+        now = time.monotonic()
+        # answers are given with remaining ttl
+        result = [Answer(key[0], key[1], key[2], int(record.expires_at - now), rdata=record.data)
+            for record in records if now < record.expires_at]
+
+        if len(result) != len(records):
+            self._set_records(key, self._get_alive_records(records, now))
+        if len(result) > 0:
+            self.cache.move_to_end(key)
+            if self.on_expiring is not None:
+                self._count_hit(key, now)
+        return result
+
+    def find_stale_answers(self, question):
+        # records kept within stale window, answered with STALE_TTL
+        records = self.cache.get((question.name, question.tp, question.cl))
+        if records is None:
+            return []
+        now = time.monotonic()
+        return [Answer(question.name, question.tp, question.cl, STALE_TTL, rdata=record.data)
+            for record in records if now < record.expires_at + self.stale_window]
+
+    def _count_hit(self, key, now):
+        hits = self.hits.get(key, 0) + 1
+        self.hits[key] = hits
+        item = min(self.cache[key], key=lambda item: item.expires_at)
+        if item.expires_at - now < EXPIRING_FRACTION * item.ttl:
+            self.on_expiring(key, hits)
+
+    def add_negative(self, question, rcode, soa):
+        # NXDOMAIN applies to all types of name, NODATA only to asked one
+        tp = None if rcode == rcodes['NXDOMAIN'] else question.tp
+        key = (question.name, tp, question.cl)
+        now = time.monotonic()
+        self._remove_expired_negative(now)
+
+        expires_at = now + min(soa.ttl, get_soa_minimum(soa.data))
+        self.negative_cache[key] = NegativeItem(rcode, soa, expires_at)
+        self.negative_cache.move_to_end(key)
+        heapq.heappush(self.negative_expiry_heap, (expires_at, key))
+
+        if self.max_entries is not None and len(self.negative_cache) > self.max_entries:
+            self.negative_cache.popitem(last=False)
+            self.evictions += 1
+
+    def find_negative(self, question):
+        # returns rcode and SOA with remaining ttl, or None
+        now = time.monotonic()
+        for tp in (question.tp, None):
+            key = (question.name, tp, question.cl)
+            item = self.negative_cache.get(key)
+            if item is None:
+                continue
+            if now >= item.expires_at:
+                del self.negative_cache[key]
+                self.expirations += 1
+                continue
 
-            self.cache[key] = alive_records
-            return result
-        return []
+            self.negative_cache.move_to_end(key)
+            soa = item.soa
+            return item.rcode, Answer(
+                soa.name, soa.tp, soa.cl, int(item.expires_at - now), soa.data)
+        return None
 
-    def _get_alive_records(self, records):
-        alive_records = []
+    def _remove_expired_negative(self, now):
+        heap = self.negative_expiry_heap
+        while len(heap) > 0 and heap[0][0] <= now:
+            _, key = heapq.heappop(heap)
+            item = self.negative_cache.get(key)
+            if item is not None and item.expires_at <= now:
+                del self.negative_cache[key]
+                self.expirations += 1
 
+        if len(heap) > 2 * len(self.negative_cache) + 64:
+            self.negative_expiry_heap = [
+                (item.expires_at, key) for key, item in self.negative_cache.items()]
+            heapq.heapify(self.negative_expiry_heap)
+
+    def _index_delegation(self, name, tp, rdata, expires_at):
+        if tp == types['NS']:
+            self.delegations.add_ns(name, rdata, expires_at)
+        elif tp == types['A']:
+            self.delegations.add_address(name, socket.inet_ntoa(rdata), expires_at)
+
+    def _unindex_delegation(self, key, records):
+        # records left the cache, so index does not outgrow it
+        if key[1] == types['NS']:
+            for record in records:
+                self.delegations.remove_ns(key[0], record.data)
+        elif key[1] == types['A']:
+            for record in records:
+                self.delegations.remove_address(key[0], socket.inet_ntoa(record.data))
+
+    def _get_alive_records(self, records, now):
+        return [record for record in records if now < record.expires_at + self.stale_window]
+
+    def _set_records(self, key, alive_records):
+        records = self.cache[key]
+        removed = len(records) - len(alive_records)
+        if removed == 0:
+            return
+
+        self.expirations += removed
+        self._unindex_delegation(
+            key, [record for record in records if record not in alive_records])
         for record in records:
-            expires_at = record.cached_at + datetime.timedelta(seconds=record.ttl)
-            if datetime.datetime.now() < expires_at:
-                alive_records.append(record)
-        return alive_records
+            self.size_bytes -= self._item_size(key, record)
+        if len(alive_records) == 0:
+            del self.cache[key]
+            self.hits.pop(key, None)
+            return
+
+        for record in alive_records:
+            self.size_bytes += self._item_size(key, record)
+        self.cache[key] = alive_records
+
+    def _remove_expired(self, now):
+        heap = self.expiry_heap
+        while len(heap) > 0 and heap[0][0] + self.stale_window <= now:
+            _, key = heapq.heappop(heap)
+            if key in self.cache:
+                self._set_records(key, self._get_alive_records(self.cache[key], now))
+                # the next expiring record of key gets its own entry
+                records = self.cache.get(key)
+                if records is not None:
+                    heapq.heappush(heap, (min(item.expires_at for item in records), key))
+
+        # heap keeps entries of replaced and evicted records until they expire
+        if len(heap) > 2 * len(self.cache) + 64:
+            self.expiry_heap = [
+                (min(item.expires_at for item in records), key)
+                for key, records in self.cache.items()]
+            heapq.heapify(self.expiry_heap)
+
+    def _evict(self):
+        while len(self.cache) > 0 and (
+                self.max_entries is not None and len(self.cache) > self.max_entries
+                or self.max_bytes is not None and self.size_bytes > self.max_bytes):
+            key, records = self.cache.popitem(last=False)
+            self._unindex_delegation(key, records)
+            for record in records:
+                self.size_bytes -= self._item_size(key, record)
+            self.hits.pop(key, None)
+            self.evictions += 1
+
+    def _item_size(self, key, item):
+        return len(key[0]) + len(item.data) + Cache.ITEM_OVERHEAD
 
 
 class CsvCacheManager:
     FIELDS = ['name', 'tp', 'cl', 'ttl', 'data', 'cached_at']
 
     @staticmethod
-    def load_cache_from(file_name):
-        cache = Cache()
+    def load_cache_from(file_name, cache=None):
+        if cache is None:
+            cache = Cache()
 
-        with open(file_name, 'r', encoding='utf-8') as csv_cache:
+        with open(file_name, 'r', encoding='utf-8', newline='') as csv_cache:
             reader = DictReader(csv_cache, CsvCacheManager.FIELDS)
             next(reader)
+            now = datetime.datetime.now()
+            monotonic_now = time.monotonic()
+            records = OrderedDict()
             for row in reader:
                 cached_at = datetime.datetime.strptime(row['cached_at'], '%Y-%m-%d %H:%M:%S.%f')
-                cache.add_answer(
-                    Answer(row['name'], int(row['tp']), int(row['cl']), 
-                        int(row['ttl']), row['data']), cached_at)
+                ttl = int(row['ttl'])
+                expires_at = monotonic_now + ttl - (now - cached_at).total_seconds()
+                key = (sys.intern(row['name']), int(row['tp']), int(row['cl']))
+                try:
+                    data = pack_data(key[1], row['data'])
+                except UnicodeEncodeError:
+                    # raw data was saved cp1251 decoded before
+                    data = row['data'].encode('cp1251')
+                except (OSError, ValueError):
+                    data = CsvCacheManager._convert_legacy_address(key[1], row['data'])
+                    if data is None:
+                        continue
+                records.setdefault(key, []).append(CacheItem(data, ttl, expires_at))
 
+        cache.load_records(records.items())
         return cache
 
+    @staticmethod
+    def _convert_legacy_address(tp, data):
+        # AAAA records were saved as cp1251 decoded packed address before,
+        # None if data is not an address
+        if tp != types['AAAA']:
+            return None
+        try:
+            data = data.encode('cp1251')
+        except UnicodeEncodeError:
+            return None
+        return data if len(data) == 16 else None
+
     @staticmethod
     def save_cache_to(cache, file_name):
-        with open(file_name, 'w', encoding='utf-8') as csv_cache:
-            with cache.cache_lock:
-                writer = DictWriter(csv_cache, CsvCacheManager.FIELDS)
-                writer.writeheader()
+        with open(file_name, 'w', encoding='utf-8', newline='') as csv_cache:
+            writer = DictWriter(csv_cache, CsvCacheManager.FIELDS)
+            writer.writeheader()
+            now = datetime.datetime.now()
+            monotonic_now = time.monotonic()
+
+            for (name, tp, cl), records in cache.get_records():
+                for item in records:
+                    cached_at = now + datetime.timedelta(
+                        seconds=item.expires_at - item.ttl - monotonic_now)
+                    writer.writerow(
+                        {
+                            'name': name, 'tp': tp, 'cl': cl,
+                            'ttl': item.ttl, 'data': unpack_data(tp, item.data),
+                            'cached_at': cached_at.strftime('%Y-%m-%d %H:%M:%S.%f')
+                        })
+
+
+class BinaryCacheManager:
+    '''
+        Snapshot of cache: header, table of names, fixed-size records
+        and blob of their data. Expiry times are absolute (wall clock),
+        A and AAAA records data is packed.
+    '''
+    MAGIC = b'DNSC'
+    VERSION = 1
+    # magic, version, saved_at, names count, records count
+    HEADER = struct.Struct('!4sHdII')
+    NAME_LENGTH = struct.Struct('!H')
+    # name index, tp, cl, ttl, expires_at, data offset, data length
+    RECORD = struct.Struct('!IHHIdIH')
+
+    @staticmethod
+    def load_cache_from(file_name, cache=None):
+        if cache is None:
+            cache = Cache()
+
+        # collections triggered by millions of new objects take most of load time
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(file_name, 'rb') as snapshot:
+                with mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as memory:
+                    records = BinaryCacheManager._read_records(memory, cache.stale_window)
+            cache.load_records(records.items())
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return cache
+
+    @staticmethod
+    def _read_records(memory, stale_window):
+        magic, version, _, names_count, records_count = \
+            BinaryCacheManager.HEADER.unpack_from(memory, 0)
+        if magic != BinaryCacheManager.MAGIC or version != BinaryCacheManager.VERSION:
+            raise ValueError('Unsupported cache snapshot version {}'.format(version))
+
+        offset = BinaryCacheManager.HEADER.size
+        names = []
+        for i in range(names_count):
+            length = BinaryCacheManager.NAME_LENGTH.unpack_from(memory, offset)[0]
+            offset += BinaryCacheManager.NAME_LENGTH.size
+            names.append(sys.intern(memory[offset:offset + length].decode('utf-8')))
+            offset += length
+
+        data_start = offset + records_count * BinaryCacheManager.RECORD.size
+        data_blob = memory[data_start:]
+        now = time.time()
+        monotonic_now = time.monotonic()
+        records = OrderedDict()
+        # records of one key are saved in a row
+        last_key = None
+        items = None
+        for name_index, tp, cl, ttl, expires_at, data_offset, data_length in \
+                BinaryCacheManager.RECORD.iter_unpack(memory[offset:data_start]):
+            if expires_at + stale_window <= now:
+                continue
+            data = rdata_from_bytes(tp, data_blob[data_offset:data_offset + data_length])
+            key = (name_index, tp, cl)
+            if key != last_key:
+                last_key = key
+                key = (names[name_index], tp, cl)
+                items = records.get(key)
+                if items is None:
+                    items = records[key] = []
+            items.append(CacheItem(data, ttl, monotonic_now + expires_at - now))
+        return records
+
+    @staticmethod
+    def save_cache_to(cache, file_name):
+        now = time.time()
+        monotonic_now = time.monotonic()
+        # name -> index in names table
+        names = dict()
+        name_parts = []
+        record_parts = []
+        data_parts = []
+        data_size = 0
+
+        for (name, tp, cl), items in cache.get_records():
+            index = names.get(name)
+            if index is None:
+                index = names[name] = len(names)
+                encoded_name = name.encode('utf-8')
+                name_parts.append(
+                    BinaryCacheManager.NAME_LENGTH.pack(len(encoded_name)) + encoded_name)
+
+            for item in items:
+                if item.expires_at + cache.stale_window <= monotonic_now:
+                    continue
+                data = rdata_to_bytes(tp, item.data)
+                record_parts.append(BinaryCacheManager.RECORD.pack(
+                    index, tp, cl, item.ttl, now + item.expires_at - monotonic_now,
+                    data_size, len(data)))
+                data_parts.append(data)
+                data_size += len(data)
 
-                for name, tp, cl in cache.cache.keys():
-                    for item in cache.cache[(name, tp, cl)]:
-                        writer.writerow(
-                            {
-                                'name': name, 'tp': tp, 'cl': cl, 
-                                **item.__dict__
-                            })
+        with open(file_name, 'wb') as snapshot:
+            snapshot.write(BinaryCacheManager.HEADER.pack(
+                BinaryCacheManager.MAGIC, BinaryCacheManager.VERSION,
+                now, len(names), len(record_parts)))
+            snapshot.write(b''.join(name_parts))
+            snapshot.write(b''.join(record_parts))
+            snapshot.write(b''.join(data_parts))
+
+
+SNAPSHOT_FORMATS = {
+    'binary': BinaryCacheManager,
+    'csv': CsvCacheManager,
+}
+
+
+def get_cache_manager(file_name):
+    # format of saved cache is detected by its first bytes
+    with open(file_name, 'rb') as snapshot:
+        magic = snapshot.read(len(BinaryCacheManager.MAGIC))
+    if magic == BinaryCacheManager.MAGIC:
+        return BinaryCacheManager
+    return CsvCacheManager
 
 
 def cache_test_found():
-    record1 = Answer('google.com.', 1, 1, 3, 'data1')
-    record2 = Answer('google.com.', 1, 1, 4, 'data2')
+    record1 = Answer('google.com.', 1, 1, 3, '10.0.0.1')
+    record2 = Answer('google.com.', 1, 1, 4, '10.0.0.2')
     cache = Cache()
     cache.add_answer(record1)
     cache.add_answer(record2)
@@ -114,15 +539,15 @@ def cache_test_found():
 
 
 def cache_test_expired():
-    record = Answer('google.com.', 1, 1, -1, 'data')
+    record = Answer('google.com.', 1, 1, -1, '10.0.0.1')
     cache = Cache()
     cache.add_answer(record)
     print(cache.find_answers(Question('google.com.', 1, 1)))
 
 
 def cache_save_test():
-    record1 = Answer('google.com.', 1, 1, 3, 'data1')
-    record2 = Answer('google.com.', 1, 1, 4, 'data2')
+    record1 = Answer('google.com.', 1, 1, 3, '10.0.0.1')
+    record2 = Answer('google.com.', 1, 1, 4, '10.0.0.2')
     cache = Cache()
     cache.add_answer(record1)
     cache.add_answer(record2)
@@ -135,8 +560,77 @@ def cache_load_test():
     for answer in cache.find_answers(Question('google.com.', 1, 1)):
         print(answer.__dict__)
 
+def cache_test_answers():
+    return [
+        Answer('google.com.', types['A'], 1, 300, '10.0.0.1'),
+        Answer('google.com.', types['A'], 1, 300, '10.0.0.2'),
+        Answer('google.com.', types['AAAA'], 1, 300, '2001:db8::1'),
+        Answer('google.com.', types['NS'], 1, 3600, 'ns1.google.com.'),
+        Answer('ns1.google.com.', types['A'], 1, 3600, '10.0.1.1'),
+        Answer('1.1.0.10.in-addr.arpa.', types['PTR'], 1, 60, 'ns1.google.com.'),
+        # TXT, raw rdata of other types may have any bytes
+        Answer('google.com.', 16, 1, 300, rdata=b'\x04\x98\xff\x00a'),
+    ]
+
+
+def cache_test_check_answers(cache, answers):
+    for answer in answers:
+        found = cache.find_answers(Question(answer.name, answer.tp, answer.cl))
+        assert answer.data in [found_answer.data for found_answer in found], answer.__dict__
+        assert all(0 < found_answer.ttl <= answer.ttl for found_answer in found)
+    assert cache.delegations.find_nearest('www.google.com.', time.monotonic()) == ['10.0.1.1']
+
+
+def cache_test_binary_round_trip():
+    answers = cache_test_answers()
+    cache = Cache()
+    for answer in answers:
+        cache.add_answer(answer)
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'cache.bin')
+        BinaryCacheManager.save_cache_to(cache, file_name)
+        loaded = BinaryCacheManager.load_cache_from(file_name)
+    assert len(loaded.cache) == len(cache.cache)
+    cache_test_check_answers(loaded, answers)
+
+
+def cache_test_csv_round_trip():
+    answers = cache_test_answers()
+    cache = Cache()
+    for answer in answers:
+        cache.add_answer(answer)
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'cache.csv')
+        CsvCacheManager.save_cache_to(cache, file_name)
+        loaded = CsvCacheManager.load_cache_from(file_name)
+    cache_test_check_answers(loaded, answers)
+
+
+def cache_test_csv_legacy_aaaa():
+    # AAAA data was saved cp1251 decoded before
+    address = socket.inet_pton(socket.AF_INET6, '2001:db8::1')
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'cache.csv')
+        with open(file_name, 'w', encoding='utf-8', newline='') as csv_cache:
+            writer = DictWriter(csv_cache, CsvCacheManager.FIELDS)
+            writer.writeheader()
+            cached_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+            for data in (address.decode('cp1251'), 'short'):
+                writer.writerow({'name': 'google.com.', 'tp': types['AAAA'], 'cl': 1,
+                    'ttl': 300, 'data': data, 'cached_at': cached_at})
+        cache = CsvCacheManager.load_cache_from(file_name)
+
+    found = cache.find_answers(Question('google.com.', types['AAAA'], 1))
+    assert [answer.data for answer in found] == ['2001:db8::1']
+
+
 if __name__ == "__main__":
     cache_test_found()
     cache_test_expired()
+    cache_test_binary_round_trip()
+    cache_test_csv_round_trip()
+    cache_test_csv_legacy_aaaa()
     #cache_save_test()
     #cache_load_test()
\ No newline at end of file
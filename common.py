@@ -5,6 +5,7 @@ classes = {
 types = {
     'A': 1,
     'NS': 2,
+    'SOA': 6,
     'PTR': 12,
     'AAAA': 28,
 }
@@ -12,10 +13,18 @@ types = {
 inv_types = {
     1: 'A',
     2: 'NS',
+    6: 'SOA',
     12: 'PTR',
     28: 'AAAA'
 }
 
 inv_classes = {
     1 : 'IN'
-}
\ No newline at end of file
+}
+
+rcodes = {
+    'NOERROR': 0,
+    'SERVFAIL': 2,
+    'NXDOMAIN': 3,
+    'REFUSED': 5,
+}
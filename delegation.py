@@ -0,0 +1,103 @@
+import time
+
+
+class DelegationIndex:
+    '''
+        Known zone cuts with their nameservers and nameserver addresses.
+        Deepest cut above a name is found in one pass over its suffixes.
+        Updated from Cache as records are added and removed,
+        so holds the same locking rules.
+    '''
+    def __init__(self, max_zones=None):
+        # zone -> {ns_name: expires_at}
+        self.zones = dict()
+        # ns_name -> {addr: expires_at}
+        self.addresses = dict()
+        # ns_name -> number of zones it serves, addresses of unused ones are dropped
+        self.zone_counts = dict()
+        # expired entries are swept when index doubles in size
+        self.cleanup_size = 1024
+        # limit for indexes not trimmed together with cache, oldest zones go first
+        self.max_zones = max_zones
+
+    def add_ns(self, zone, ns_name, expires_at):
+        if len(self.zones) + len(self.addresses) > self.cleanup_size:
+            self.remove_expired(time.monotonic())
+            self.cleanup_size = 2 * (len(self.zones) + len(self.addresses)) + 1024
+
+        nameservers = self.zones.get(zone)
+        if nameservers is None:
+            if self.max_zones is not None and len(self.zones) >= self.max_zones:
+                oldest = next(iter(self.zones))
+                for old_ns_name in list(self.zones[oldest]):
+                    self._remove_ns(oldest, old_ns_name)
+            nameservers = self.zones[zone] = dict()
+        if ns_name not in nameservers:
+            self.zone_counts[ns_name] = self.zone_counts.get(ns_name, 0) + 1
+            if ns_name not in self.addresses:
+                self.addresses[ns_name] = dict()
+        nameservers[ns_name] = max(expires_at, nameservers.get(ns_name, 0))
+
+    def remove_ns(self, zone, ns_name):
+        self._remove_ns(zone, ns_name)
+
+    def _remove_ns(self, zone, ns_name):
+        # used inside add_ns too, so not wrapped in lock by ShardedCache
+        nameservers = self.zones.get(zone)
+        if nameservers is None or ns_name not in nameservers:
+            return
+        del nameservers[ns_name]
+        if len(nameservers) == 0:
+            del self.zones[zone]
+
+        count = self.zone_counts[ns_name] - 1
+        if count == 0:
+            del self.zone_counts[ns_name]
+            del self.addresses[ns_name]
+        else:
+            self.zone_counts[ns_name] = count
+
+    def add_address(self, ns_name, addr, expires_at):
+        # addresses are kept only for names known as nameservers
+        addrs = self.addresses.get(ns_name)
+        if addrs is not None:
+            addrs[addr] = max(expires_at, addrs.get(addr, 0))
+
+    def remove_address(self, ns_name, addr):
+        addrs = self.addresses.get(ns_name)
+        if addrs is not None:
+            addrs.pop(addr, None)
+
+    def find_nearest(self, name, now):
+        # addresses of nameservers of the deepest known zone containing name
+        pos = 0
+        while pos < len(name):
+            nameservers = self.zones.get(name[pos:])
+            if nameservers is not None:
+                addrs = self._find_addresses(nameservers, now)
+                if len(addrs) > 0:
+                    return addrs
+            pos = name.find('.', pos) + 1
+            if pos == 0:
+                break
+        return []
+
+    def _find_addresses(self, nameservers, now):
+        addrs = []
+        for ns_name, ns_expires_at in nameservers.items():
+            if ns_expires_at <= now:
+                continue
+            for addr, expires_at in self.addresses[ns_name].items():
+                if expires_at > now:
+                    addrs.append(addr)
+        return addrs
+
+    def remove_expired(self, now):
+        for zone in list(self.zones):
+            nameservers = self.zones[zone]
+            for ns_name in [ns for ns, expires_at in nameservers.items() if expires_at <= now]:
+                self._remove_ns(zone, ns_name)
+
+        for addrs in self.addresses.values():
+            for addr in [addr for addr, expires_at in addrs.items() if expires_at <= now]:
+                del addrs[addr]
@@ -1,41 +1,161 @@
+import socket
 import struct
+import sys
 from common import types
 
+HEADER = struct.Struct('!HHHHHH')
+QUESTION_TAIL = struct.Struct('!HH')
+RECORD_TAIL = struct.Struct('!HHIH')
+POINTER = struct.Struct('!H')
+RDLEN = struct.Struct('!H')
+SOA_TAIL = struct.Struct('!IIIII')
+# compression pointers can only address first 16Kb of package
+MAX_POINTER = 0x3FFF
+# UDP payload without EDNS0 (RFC 1035), longer responses are truncated
+MAX_UDP_PAYLOAD = 512
+# largest package, as its length over TCP is 16 bit
+MAX_PACKAGE_SIZE = 0xFFFF
+# type of OPT pseudo record of EDNS0 (RFC 6891)
+OPT = 41
+# UDP payload advertised with EDNS0, small enough to avoid IP fragmentation
+EDNS_PAYLOAD = 1232
+# data of these types is kept packed, as in wire format
+ADDRESS_FAMILIES = {
+    types['A']: socket.AF_INET,
+    types['AAAA']: socket.AF_INET6,
+}
+# data of these types is text with names, data of other types
+# than them and addresses is raw rdata, one latin-1 character per byte as text
+NAME_TYPES = {types['NS'], types['PTR'], types['SOA']}
+
+
+def normalize_name(name):
+    # names are compared case-insensitively, equal ones share one string
+    return sys.intern(name.lower())
+
+
+def pack_data(tp, data):
+    # text data to the form kept in cache: packed address, text of names or raw rdata
+    if tp in NAME_TYPES:
+        return data
+    family = ADDRESS_FAMILIES.get(tp)
+    return data.encode('latin-1') if family is None else socket.inet_pton(family, data)
+
+
+def unpack_data(tp, rdata):
+    if tp in NAME_TYPES:
+        return rdata
+    family = ADDRESS_FAMILIES.get(tp)
+    return rdata.decode('latin-1') if family is None else socket.inet_ntop(family, rdata)
+
+
+def rdata_to_bytes(tp, rdata):
+    # rdata as saved in snapshots and shared memory
+    return rdata.encode('utf-8') if tp in NAME_TYPES else rdata
+
+
+def rdata_from_bytes(tp, bts):
+    return str(bts, 'utf-8') if tp in NAME_TYPES else bytes(bts)
+
 
 def encode_name(name):
     # ensure name to by fully qualified
     encoded_name = bytearray()
-    labels = name.split('.')
-    for label in labels:
-        encoded_name.append(len(label))
-        encoded_name += bytearray(label.encode('ascii'))
-
+    write_name(encoded_name, name, None)
     return bytes(encoded_name)
 
 
+def write_name(buf, name, names):
+    # appends name to buf, names maps already written suffixes to their offsets
+    # and enables RFC 1035 compression, None disables it
+    pos = 0
+    while pos < len(name):
+        if names is not None:
+            suffix = name[pos:]
+            offset = names.get(suffix)
+            if offset is not None:
+                buf += POINTER.pack(0xC000 | offset)
+                return
+            if len(buf) <= MAX_POINTER:
+                names[suffix] = len(buf)
+
+        dot = name.find('.', pos)
+        if dot == -1:
+            dot = len(name)
+        label = name[pos:dot].encode('ascii')
+        buf.append(len(label))
+        buf += label
+        pos = dot + 1
+    buf.append(0)
+
+
+def encode_opt_record(payload):
+    # root name, type, payload size as class, no extended flags and options
+    return b'\x00' + RECORD_TAIL.pack(OPT, payload, 0, 0)
+
+
+def split_opt_record(additions):
+    # additions without OPT record and payload size advertised by it
+    payload = None
+    records = []
+    for record in additions:
+        if record.tp == OPT:
+            payload = record.cl
+        else:
+            records.append(record)
+    return records, payload
+
+
 def get_parent_domain(domain_name):
     return '.'.join(domain_name.split('.')[1:])
 
 
-def construct_query_from_questions(id, questions):
+def construct_query_from_questions(id, questions, edns_payload=None):
     dns_query = DNSPackage()
     dns_query.id = id
     dns_query.qr = 0
     dns_query.rd = 1
     dns_query.qdcount = len(questions)
     dns_query.questions = questions
+    dns_query.edns_payload = edns_payload
     return dns_query
 
 
-def construct_response_from_answers(id, answers):
+def construct_response_from_answers(id, answers, rcode=0, authorities=()):
     dns_response = DNSPackage()
     dns_response.id = id
     dns_response.qr = 1
+    dns_response.rcode = rcode
     dns_response.ancount = len(answers)
     dns_response.answers = answers
+    dns_response.nscount = len(authorities)
+    dns_response.authorities = list(authorities)
     return dns_response
 
 
+def get_soa_minimum(soa_data):
+    # soa data is 'mname rname serial refresh retry expire minimum'
+    return int(soa_data.split()[6])
+
+
+def get_negative_soa(authorities):
+    # SOA records of negative answer with ttl reduced to SOA minimum (RFC 2308)
+    return [
+        Answer(record.name, record.tp, record.cl,
+            min(record.ttl, get_soa_minimum(record.data)), record.data)
+        for record in authorities if record.tp == types['SOA']]
+
+
+class Resolution:
+    def __init__(self, answers, rcode=0, authorities=(), stale=False):
+        self.answers = answers
+        self.rcode = rcode
+        # SOA of negative answers
+        self.authorities = authorities
+        # answers are expired records served while upstream fails (RFC 8767)
+        self.stale = stale
+
+
 class DNSPackage:
     def __init__(self):
         # header values
@@ -58,19 +178,26 @@ class DNSPackage:
         self.answers = []
         self.authorities = []
         self.additions = []
+        # UDP payload size of OPT record (EDNS0), None if there is no one
+        self.edns_payload = None
      
     def to_bytes(self):
-        flags = self._flags_to_bytes()
-        b_header = struct.pack('!HHHHHH', 
-            self.id, flags, self.qdcount, self.ancount,
-            self.nscount, self.arcount)
-
-        b_questions = self._rrecords_to_bytes(self.questions)
-        b_answers = self._rrecords_to_bytes(self.answers)
-        b_authorities = self._rrecords_to_bytes(self.authorities)
-        b_additions = self._rrecords_to_bytes(self.additions)
-        
-        return b_header + b_questions + b_answers + b_authorities + b_additions
+        # whole package is written into one buffer with compressed names
+        buf = bytearray(HEADER.size)
+        arcount = self.arcount if self.edns_payload is None else self.arcount + 1
+        HEADER.pack_into(buf, 0,
+            self.id, self._flags_to_bytes(), self.qdcount, self.ancount,
+            self.nscount, arcount)
+
+        names = dict()
+        for section in (self.questions, self.answers,
+                self.authorities, self.additions):
+            for record in section:
+                record.write_to(buf, names)
+        if self.edns_payload is not None:
+            buf += encode_opt_record(self.edns_payload)
+
+        return bytes(buf)
 
     def _flags_to_bytes(self):
         flags = self.qr << 15
@@ -82,9 +209,6 @@ class DNSPackage:
         flags |= self.rcode
         return flags
 
-    def _rrecords_to_bytes(self, records):
-        return b''.join([record.to_bytes() for record in records])
-
     def dump(self):
         print('HEADER: id {0}, qr {1}'.format(self.id, self.qr))
         print('HAS {} QUESTIONS'.format(self.qdcount))
@@ -111,35 +235,58 @@ class Question:
         self.cl = cl
 
     def to_bytes(self):
-        return encode_name(self.name) + struct.pack('!HH', self.tp, self.cl)
-        
+        buf = bytearray()
+        self.write_to(buf, None)
+        return bytes(buf)
+
+    def write_to(self, buf, names):
+        write_name(buf, self.name, names)
+        buf += QUESTION_TAIL.pack(self.tp, self.cl)
+
 
 class Answer:
-    def __init__(self, name, tp, cl, ttl, data):
-       self.name = name
-       self.tp = tp
-       self.cl = cl
-       self.ttl = ttl
-       self.data = data
+    def __init__(self, name, tp, cl, ttl, data=None, rdata=None):
+        self.name = name
+        self.tp = tp
+        self.cl = cl
+        self.ttl = ttl
+        # text data or rdata as kept in cache (see pack_data) is given,
+        # the other one is converted on first access
+        self._data = data
+        self._rdata = rdata
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = unpack_data(self.tp, self._rdata)
+        return self._data
+
+    @property
+    def rdata(self):
+        if self._rdata is None:
+            self._rdata = pack_data(self.tp, self._data)
+        return self._rdata
 
     def to_bytes(self):
-        prefix = encode_name(self.name) + \
-            struct.pack('!HHI', self.tp, self.cl, self.ttl)
-        if self.tp == types['A']:
-            encoded_data = Answer._encode_a_data(self.data)
-        elif self.tp == types['NS'] or self.tp == types['PTR']:
-            encoded_data = Answer._encode_name_data(self.data)
-        else:
-            encoded_data = self.data.encode('cp1251')
+        buf = bytearray()
+        self.write_to(buf, None)
+        return bytes(buf)
 
-        rdlen = len(encoded_data)
-        return prefix + struct.pack('!H', rdlen) + encoded_data
+    def write_to(self, buf, names):
+        write_name(buf, self.name, names)
+        buf += RECORD_TAIL.pack(self.tp, self.cl, self.ttl, 0)
+        rdata_start = len(buf)
 
-    @staticmethod
-    def _encode_a_data(ip):
-        ip_bytes = [struct.pack('!B', int(ip_part)) for ip_part in ip.split('.')]
-        return b''.join(ip_bytes)
+        if self.tp in ADDRESS_FAMILIES:
+            buf += self.rdata
+        elif self.tp == types['NS'] or self.tp == types['PTR']:
+            write_name(buf, self.data, names)
+        elif self.tp == types['SOA']:
+            mname, rname, *numbers = self.data.split()
+            write_name(buf, mname, names)
+            write_name(buf, rname, names)
+            buf += SOA_TAIL.pack(*map(int, numbers))
+        else:
+            buf += self.rdata
 
-    @staticmethod
-    def _encode_name_data(domain_name):
-        return encode_name(domain_name)
+        RDLEN.pack_into(buf, rdata_start - 2, len(buf) - rdata_start)
@@ -1,6 +1,14 @@
 import argparse
+import logging
 from server import Server
-from caching import Cache, CsvCacheManager
+from caching import Cache, SNAPSHOT_FORMATS, get_cache_manager
+from sharded_cache import ShardedCache
+from snapshots import CacheJournal, Snapshotter
+from dns_structs import EDNS_PAYLOAD
+from metrics import StatsServer
+
+logger = logging.getLogger(__name__)
+LOG_LEVELS = ['debug', 'info', 'warning', 'error']
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -8,22 +16,69 @@ parser.add_argument(
 parser.add_argument(
     '--save', required=True,
     help='name of file to save cache in')
+parser.add_argument(
+    '--max-entries', type=int,
+    help='maximum number of cached names, least recently used are evicted')
+parser.add_argument(
+    '--max-bytes', type=int,
+    help='approximate maximum size of cache in bytes')
+parser.add_argument(
+    '--shards', type=int, default=1,
+    help='number of parts of cache with their own locks')
+parser.add_argument(
+    '--edns-payload', type=int, default=EDNS_PAYLOAD, metavar='SIZE',
+    help='UDP payload size advertised with EDNS0, 0 disables EDNS0')
+parser.add_argument(
+    '--snapshot-format', choices=sorted(SNAPSHOT_FORMATS), default='binary',
+    help='format of file to save cache in, format of loaded file is detected')
+parser.add_argument(
+    '--snapshot-interval', type=float, metavar='SECONDS',
+    help='save cache in background every SECONDS')
+parser.add_argument(
+    '--journal',
+    help='name of file to log records cached since the last save in, '
+        'replayed on start')
+parser.add_argument(
+    '--stats-port', type=int, metavar='PORT',
+    help='serve metrics in Prometheus text format over HTTP on 127.0.0.1:PORT')
+parser.add_argument(
+    '--log-level', choices=LOG_LEVELS, default='warning',
+    help='log messages of that level and above, debug logs every query')
 
 
 def main():
     args = parser.parse_args()
-    if args.load:
-        cache = CsvCacheManager.load_cache_from(args.load)
+    logging.basicConfig(
+        level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if args.shards > 1:
+        cache = ShardedCache(args.shards, args.max_entries, args.max_bytes)
     else:
-        cache = Cache()
+        cache = Cache(args.max_entries, args.max_bytes)
+    if args.load:
+        get_cache_manager(args.load).load_cache_from(args.load, cache)
+    if args.journal:
+        CacheJournal.replay(args.journal, cache)
+        cache.journal = CacheJournal(args.journal)
 
-    server = Server(cache)
+    server = Server(cache, args.edns_payload or None)
+    snapshotter = Snapshotter(cache, args.save, SNAPSHOT_FORMATS[args.snapshot_format],
+        args.snapshot_interval, cache.journal)
+    snapshotter.start()
+    stats_server = None
+    if args.stats_port:
+        stats_server = StatsServer(server.metrics, args.stats_port)
+        stats_server.start()
     try:
         server.run()
     except KeyboardInterrupt:
-        print('Server shutdown')
+        logger.info('Server shutdown')
     finally:
-        CsvCacheManager.save_cache_to(server.cache, args.save)
+        if stats_server is not None:
+            stats_server.stop()
+        snapshotter.stop()
+        snapshotter.snapshot()
+        if cache.journal is not None:
+            cache.journal.close()
     
        
 if __name__ == "__main__":
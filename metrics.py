@@ -0,0 +1,177 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from common import rcodes
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of latency buckets, seconds
+LATENCY_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+RCODE_NAMES = {code: name for name, code in rcodes.items()}
+
+
+class Counter:
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self, lines):
+        lines.append('# HELP {0} {1}'.format(self.name, self.help))
+        lines.append('# TYPE {0} counter'.format(self.name))
+        lines.append('{0} {1}'.format(self.name, self.value))
+
+
+class LabeledCounter:
+    '''
+        Counter split by value of one label, like rcode of response.
+    '''
+    __slots__ = ('name', 'help', 'label', 'values')
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        # label value -> count
+        self.values = dict()
+
+    def inc(self, label_value, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self, lines):
+        lines.append('# HELP {0} {1}'.format(self.name, self.help))
+        lines.append('# TYPE {0} counter'.format(self.name))
+        # copied at once, as recording thread may add values
+        for label_value, value in sorted(list(self.values.items()), key=str):
+            lines.append('{0}{{{1}="{2}"}} {3}'.format(self.name, self.label, label_value, value))
+
+
+class Histogram:
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum')
+
+    def __init__(self, name, help, bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        # the last bucket is for values over all bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, lines):
+        lines.append('# HELP {0} {1}'.format(self.name, self.help))
+        lines.append('# TYPE {0} histogram'.format(self.name))
+        counts = list(self.counts)
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), counts):
+            total += count
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(self.name, bound, total))
+        lines.append('{0}_sum {1}'.format(self.name, self.sum))
+        lines.append('{0}_count {1}'.format(self.name, total))
+
+
+class Metrics:
+    '''
+        Metrics of resolver, recorded with plain updates of numbers by
+        the serving thread and rendered in Prometheus text format on demand.
+        Stats of server parts are read when rendered, as gauges,
+        or as counters if they only grow.
+    '''
+    # stats counting events since start
+    COUNTER_STATS = {
+        'shed_queries', 'coalesced_queries', 'upstream_resolutions', 'upstream_shed_queries',
+        'prefetches', 'stale_answers', 'evictions', 'expirations'}
+
+    def __init__(self):
+        self.queries = LabeledCounter(
+            'dns_queries_total', 'Client queries.', 'transport')
+        self.responses = LabeledCounter(
+            'dns_responses_total', 'Responses to clients by rcode.', 'rcode')
+        self.cache_hits = LabeledCounter(
+            'dns_cache_hits_total', 'Questions answered from cache.', 'cache')
+        self.cache_misses = Counter(
+            'dns_cache_misses_total', 'Questions resolved from nameservers.')
+        self.upstream_queries = LabeledCounter(
+            'dns_upstream_queries_total', 'Queries sent to nameservers.', 'transport')
+        self.upstream_timeouts = Counter(
+            'dns_upstream_timeouts_total', 'Queries to nameservers left without response.')
+        self.client_latency = Histogram(
+            'dns_client_latency_seconds', 'Time from client query to response.')
+        self.upstream_latency = Histogram(
+            'dns_upstream_latency_seconds', 'Round trip time of queries to nameservers.')
+        self.metrics = [
+            self.queries, self.responses, self.cache_hits, self.cache_misses,
+            self.upstream_queries, self.upstream_timeouts,
+            self.client_latency, self.upstream_latency]
+        # (prefix, function returning dict of numbers)
+        self.stats = []
+
+    def add_stats(self, prefix, stats):
+        self.stats.append((prefix, stats))
+
+    def count_response(self, byte_response, received_at, now):
+        self.responses.inc(RCODE_NAMES.get(byte_response[3] & 0xF, byte_response[3] & 0xF))
+        self.client_latency.observe(now - received_at)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            metric.render(lines)
+        for prefix, stats in self.stats:
+            for name, value in sorted(stats().items()):
+                metric_type = 'gauge'
+                if name in Metrics.COUNTER_STATS:
+                    metric_type = 'counter'
+                    name += '_total'
+                lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, metric_type))
+                lines.append('{0}_{1} {2}'.format(prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsServer:
+    '''
+        HTTP endpoint serving metrics in Prometheus text format
+        from a background thread.
+    '''
+    def __init__(self, metrics, port, addr='127.0.0.1'):
+        self.metrics = metrics
+        self.addr = addr
+        self.port = port
+        self.http_server = None
+        self.thread = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.http_server = HTTPServer((self.addr, self.port), Handler)
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info('Stats listening on %s:%s', self.addr, self.port)
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
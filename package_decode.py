@@ -1,7 +1,18 @@
 import struct
-from dns_structs import DNSPackage, Question, Answer
+from dns_structs import (DNSPackage, Question, Answer,
+     HEADER, QUESTION_TAIL, RECORD_TAIL, RDLEN, SOA_TAIL, OPT, MAX_UDP_PAYLOAD,
+     encode_opt_record, split_opt_record, normalize_name,
+     construct_response_from_answers)
 from common import types
 
+# raised by decoders on malformed packages
+DECODE_ERRORS = (IndexError, ValueError, struct.error, UnicodeDecodeError)
+# rdata length of address records
+ADDRESS_LENGTHS = {
+    types['A']: 4,
+    types['AAAA']: 16,
+}
+
 def decode_package(bts):
     pkg = DNSPackage()
     pkg.id = unpack_short(bts[:2])
@@ -15,12 +26,13 @@ def decode_package(bts):
     offset, pkg.questions = decode_questions(bts, 12, pkg.qdcount)
     offset, pkg.answers = decode_answers(bts, offset, pkg.ancount)
     offset, pkg.authorities = decode_answers(bts, offset, pkg.nscount)
-    offset, pkg.additions = decode_answers(bts, offset, pkg.arcount)
+    offset, additions = decode_answers(bts, offset, pkg.arcount)
+    pkg.additions, pkg.edns_payload = split_opt_record(additions)
+    pkg.arcount = len(pkg.additions)
     return pkg
 
 
 def decode_flags(bts):
-    print(bts)
     return (
         (bts >> 15) & 0b1, 
         (bts >> 11) & 0b1111,
@@ -39,7 +51,7 @@ def decode_questions(bts, offset, qdcount):
         tp = unpack_short(bts[offset:offset + 2])
         cl = unpack_short(bts[offset + 2:offset + 4])
         offset += 4
-        questions.append(Question(name, tp, cl))
+        questions.append(Question(normalize_name(name), tp, cl))
 
     return offset, questions
 
@@ -54,31 +66,41 @@ def decode_answers(bts, offset, count):
 
 def _decode_answer(bts, offset):
     offset, name = decode_name(bts, offset)
-    name = name.lower()
+    name = normalize_name(name)
     tp = unpack_short(bts[offset:offset + 2])
     cl = unpack_short(bts[offset + 2:offset + 4])
     ttl = struct.unpack('!I', bts[offset + 4:offset + 8])[0]
     rdlen = unpack_short(bts[offset + 8:offset + 10])
     offset += 10
-    
-    if tp ==  types['A']:
-        data = _decode_a_data(bts, offset)
-    elif tp == types['NS'] or tp == types['PTR']:
-        data = _decode_name_data(bts, offset)
+
+    if tp == types['NS'] or tp == types['PTR']:
+        answer = Answer(name, tp, cl, ttl, _decode_name_data(bts, offset))
+    elif tp == types['SOA']:
+        answer = Answer(name, tp, cl, ttl, _decode_soa_data(bts, offset))
     else:
-        data = bts[offset:offset + rdlen].decode('cp1251')
+        # addresses, OPT and other types are kept as raw rdata
+        answer = Answer(name, tp, cl, ttl, rdata=_check_rdata(tp, bts[offset:offset + rdlen]))
     offset += rdlen
-    return offset, Answer(name, tp, cl, ttl, data)
+    return offset, answer
 
 
-def _decode_a_data(bts, offset):
-    data = bts[offset:offset + 4]
-    ip_parts = struct.unpack('!BBBB', data)
-    return '.'.join(map(str, ip_parts))
+def _check_rdata(tp, rdata):
+    # addresses are turned into text later, so malformed ones are rejected here
+    length = ADDRESS_LENGTHS.get(tp)
+    if length is not None and len(rdata) != length:
+        raise ValueError('Address rdata of {} bytes'.format(len(rdata)))
+    return bytes(rdata)
 
 
 def _decode_name_data(bts, offset):
-    return decode_name(bts, offset)[1].lower()
+    return normalize_name(decode_name(bts, offset)[1])
+
+
+def _decode_soa_data(bts, offset):
+    offset, mname = decode_name(bts, offset)
+    offset, rname = decode_name(bts, offset)
+    numbers = SOA_TAIL.unpack(bts[offset:offset + SOA_TAIL.size])
+    return ' '.join([normalize_name(mname), normalize_name(rname)] + list(map(str, numbers)))
 
 def decode_name(bts, offset):
     labels = []
@@ -90,6 +112,9 @@ def decode_name(bts, offset):
         if length & pointer_mask != 0:
             reduce_mask = (1 << 16) - (0b11 << 14) - 1
             pointer = unpack_short(bts[offset:offset + 2]) & reduce_mask
+            # pointers to prior names only, so loops end
+            if pointer >= offset:
+                raise ValueError('Compression pointer does not point back')
             prefix = '' if len(labels) == 0 else '.'.join(labels) + '.'
             return offset + 2, prefix + decode_name(bts, pointer)[1]
 
@@ -101,5 +126,274 @@ def decode_name(bts, offset):
     return offset + 1, '.'.join(labels)
 
 
+def find_ttl_offsets(bts):
+    # offsets of TTL fields of all resource records in encoded package
+    qdcount, ancount, nscount, arcount = struct.unpack('!HHHH', bts[4:12])
+    offset = 12
+    for i in range(qdcount):
+        offset = skip_name(bts, offset) + 4
+
+    ttl_offsets = []
+    for i in range(ancount + nscount + arcount):
+        offset = skip_name(bts, offset)
+        # OPT record keeps extended flags in place of TTL
+        if unpack_short(bts[offset:offset + 2]) != OPT:
+            ttl_offsets.append(offset + 4)
+        rdlen = unpack_short(bts[offset + 8:offset + 10])
+        offset += 10 + rdlen
+    return ttl_offsets
+
+
+def truncate_package(bts, max_size):
+    # package longer than max_size is cut to header and questions with TC flag
+    if len(bts) <= max_size:
+        return bts
+    qdcount = unpack_short(bts[4:6])
+    offset = 12
+    for i in range(qdcount):
+        offset = skip_name(bts, offset) + 4
+    flags = unpack_short(bts[2:4]) | 1 << 9
+    return bytes(bts[:2]) + struct.pack('!HHHHH', flags, qdcount, 0, 0, 0) + bytes(bts[12:offset])
+
+
+def fit_response(bts, max_size, edns_payload=None):
+    # response cut to max_size, with OPT record advertising edns_payload
+    if edns_payload is None:
+        return truncate_package(bts, max_size)
+    opt_record = encode_opt_record(edns_payload)
+    bts = truncate_package(bts, max_size - len(opt_record))
+    arcount = unpack_short(bts[10:12]) + 1
+    return bytes(bts[:10]) + RDLEN.pack(arcount) + bytes(bts[12:]) + opt_record
+
+
+def fit_udp_response(bts, client_payload, edns_payload):
+    # response for UDP client advertising client_payload, None if it has no EDNS0,
+    # edns_payload is advertised by server, None if EDNS0 is disabled
+    if client_payload is None or edns_payload is None:
+        return fit_response(bts, MAX_UDP_PAYLOAD)
+    # client advertised larger payload (RFC 6891)
+    max_size = max(min(client_payload, edns_payload), MAX_UDP_PAYLOAD)
+    return fit_response(bts, max_size, edns_payload)
+
+
+def skip_name(bts, offset):
+    pointer_mask = 0b11 << 6
+    while bts[offset] != 0:
+        if bts[offset] & pointer_mask != 0:
+            return offset + 2
+        offset += bts[offset] + 1
+    return offset + 1
+
+
 def unpack_short(bts):
     return struct.unpack('!H', bts)[0]
+
+
+class LazyDNSPackage(DNSPackage):
+    '''
+        Package decoded from memoryview on demand:
+        header is decoded immediately, sections on first access.
+    '''
+    SECTIONS = ('_questions', '_answers', '_authorities', '_additions')
+
+    def __init__(self, bts):
+        # base initializer assigns empty sections, treat them as decoded
+        self._decoded = len(LazyDNSPackage.SECTIONS)
+        super().__init__()
+        self._view = memoryview(bts)
+        # offset where the next not decoded section starts
+        self._offset = 12
+        self._decoded = 0
+
+        (self.id, flags, self.qdcount, self.ancount,
+            self.nscount, self.arcount) = HEADER.unpack_from(self._view, 0)
+        self.qr, self.opcode, self.auth, self.trunc, self.rd, self.ra, self.rcode = \
+            decode_flags(flags)
+
+    def _get_section(self, index):
+        while self._decoded <= index:
+            self._decode_next_section()
+        return getattr(self, LazyDNSPackage.SECTIONS[index])
+
+    def _set_section(self, index, records):
+        # earlier sections must be decoded to know where later ones start
+        if index > 0:
+            self._get_section(index - 1)
+        setattr(self, LazyDNSPackage.SECTIONS[index], records)
+        self._decoded = max(self._decoded, index + 1)
+
+    def _decode_next_section(self):
+        view, offset = self._view, self._offset
+        if self._decoded == 0:
+            offset, records = decode_questions_view(view, offset, self.qdcount)
+        else:
+            count = (self.ancount, self.nscount, self.arcount)[self._decoded - 1]
+            offset, records = decode_answers_view(view, offset, count)
+        if self._decoded == 3:
+            records, self._edns_payload = split_opt_record(records)
+            self.arcount = len(records)
+        setattr(self, LazyDNSPackage.SECTIONS[self._decoded], records)
+        self._offset = offset
+        self._decoded += 1
+
+    questions = property(
+        lambda self: self._get_section(0),
+        lambda self, records: self._set_section(0, records))
+    answers = property(
+        lambda self: self._get_section(1),
+        lambda self, records: self._set_section(1, records))
+    authorities = property(
+        lambda self: self._get_section(2),
+        lambda self, records: self._set_section(2, records))
+    additions = property(
+        lambda self: self._get_section(3),
+        lambda self, records: self._set_section(3, records))
+
+    # OPT record is decoded with additions
+    def _get_edns_payload(self):
+        self._get_section(3)
+        return self._edns_payload
+
+    def _set_edns_payload(self, payload):
+        self._get_section(3)
+        self._edns_payload = payload
+
+    edns_payload = property(_get_edns_payload, _set_edns_payload)
+
+
+def decode_package_lazy(bts):
+    return LazyDNSPackage(bts)
+
+
+def decode_questions_view(view, offset, qdcount):
+    questions = []
+    for i in range(qdcount):
+        offset, name = decode_name_view(view, offset)
+        tp, cl = QUESTION_TAIL.unpack_from(view, offset)
+        offset += 4
+        questions.append(Question(normalize_name(name), tp, cl))
+    return offset, questions
+
+
+def decode_answers_view(view, offset, count):
+    answers = []
+    for i in range(count):
+        offset, name = decode_name_view(view, offset)
+        tp, cl, ttl, rdlen = RECORD_TAIL.unpack_from(view, offset)
+        offset += 10
+
+        name = normalize_name(name)
+        if tp == types['NS'] or tp == types['PTR']:
+            answer = Answer(name, tp, cl, ttl, normalize_name(decode_name_view(view, offset)[1]))
+        elif tp == types['SOA']:
+            soa_offset, mname = decode_name_view(view, offset)
+            soa_offset, rname = decode_name_view(view, soa_offset)
+            numbers = SOA_TAIL.unpack_from(view, soa_offset)
+            answer = Answer(name, tp, cl, ttl, ' '.join(
+                [normalize_name(mname), normalize_name(rname)] + list(map(str, numbers))))
+        else:
+            answer = Answer(name, tp, cl, ttl,
+                rdata=_check_rdata(tp, view[offset:offset + rdlen]))
+        offset += rdlen
+        answers.append(answer)
+    return offset, answers
+
+
+def decode_name_view(view, offset):
+    labels = []
+    end = None
+    jumps = 0
+
+    length = view[offset]
+    while length != 0:
+        if length & 0b11000000:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 127:
+                raise ValueError('Compression pointers loop')
+            offset = ((length & 0b111111) << 8) | view[offset + 1]
+        else:
+            labels.append(str(view[offset + 1:offset + 1 + length], 'ascii'))
+            offset += length + 1
+        length = view[offset]
+
+    labels.append('')
+    if end is None:
+        end = offset + 1
+    return end, '.'.join(labels)
+
+
+def package_test_compression():
+    # names are compressed (RFC 1035 4.1.4) and decoded back by both decoders
+    response = construct_response_from_answers(7, [
+        Answer('www.google.com.', types['A'], 1, 300, '10.0.0.1'),
+        Answer('www.google.com.', types['AAAA'], 1, 300, '2001:db8::1'),
+    ], authorities=[
+        Answer('google.com.', types['NS'], 1, 3600, 'ns1.google.com.'),
+        Answer('google.com.', types['SOA'], 1, 3600,
+            'ns1.google.com. dns-admin.google.com. 1 900 900 1800 60'),
+    ])
+    response.questions = [Question('www.google.com.', types['A'], 1)]
+    response.qdcount = 1
+    bts = response.to_bytes()
+
+    uncompressed = bytearray(HEADER.size)
+    for section in (response.questions, response.answers, response.authorities):
+        for record in section:
+            record.write_to(uncompressed, None)
+    assert bts.count(b'\x06google\x03com\x00') == 1
+    assert len(bts) < len(uncompressed) - 40
+
+    for decoded in (decode_package(bts), decode_package_lazy(bts)):
+        assert decoded.id == 7
+        assert [question.name for question in decoded.questions] == ['www.google.com.']
+        for section, expected in ((decoded.answers, response.answers),
+                (decoded.authorities, response.authorities)):
+            assert [(record.name, record.tp, record.ttl, record.data) for record in section] == \
+                [(record.name, record.tp, record.ttl, record.data) for record in expected]
+
+
+def package_test_raw_rdata():
+    # OPT options and unknown types are kept as bytes, whatever they contain
+    option = b'\x00\x0a\x00\x08' + bytes([0x98] * 8)
+    txt = b'\x04\x98\xff\x00a'
+    bts = HEADER.pack(3, 0x8000, 0, 1, 0, 1) + \
+        b'\x00' + RECORD_TAIL.pack(16, 1, 60, len(txt)) + txt + \
+        b'\x00' + RECORD_TAIL.pack(OPT, 4096, 0, len(option)) + option
+    for decoded in (decode_package(bts), decode_package_lazy(bts)):
+        assert decoded.edns_payload == 4096 and decoded.additions == []
+        answer = decoded.answers[0]
+        assert answer.rdata == txt
+        assert answer.to_bytes() == b'\x00' + RECORD_TAIL.pack(16, 1, 60, len(txt)) + txt
+
+
+def package_test_pointer_loop():
+    # pointer to itself is rejected instead of looping forever
+    bts = HEADER.pack(1, 0x8000, 1, 0, 0, 0) + b'\xc0\x0c' + QUESTION_TAIL.pack(1, 1)
+    for decode in (decode_package, lambda bts: decode_package_lazy(bts).questions):
+        try:
+            decode(bts)
+        except DECODE_ERRORS:
+            continue
+        raise AssertionError('pointer loop was decoded')
+
+
+def package_test_address_length():
+    # address of wrong length is a malformed package, not a crash of caller
+    for tp, rdata in ((types['A'], b'\x0a'), (types['AAAA'], bytes(4))):
+        bts = HEADER.pack(1, 0x8000, 0, 1, 0, 0) + \
+            b'\x00' + RECORD_TAIL.pack(tp, 1, 60, len(rdata)) + rdata
+        for decode in (decode_package, lambda bts: decode_package_lazy(bts).answers):
+            try:
+                decode(bts)
+            except DECODE_ERRORS:
+                continue
+            raise AssertionError('address of {} bytes was decoded'.format(len(rdata)))
+
+
+if __name__ == "__main__":
+    package_test_compression()
+    package_test_raw_rdata()
+    package_test_pointer_loop()
+    package_test_address_length()
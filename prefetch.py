@@ -0,0 +1,42 @@
+from dns_structs import Question
+
+
+class Prefetcher:
+    '''
+        Refreshes popular records in the last part of their TTL
+        through usual upstream resolution, so hot names do not expire.
+        Called by caches from any thread, prefetches run in event loop.
+    '''
+    # hits of record before it is worth refreshing
+    MIN_HITS = 3
+
+    def __init__(self, loop, resolve, max_parallel=10):
+        self.loop = loop
+        # coroutine function resolving question from upstream
+        self.resolve = resolve
+        self.max_parallel = max_parallel
+        # (name, tp, cl) of records being refreshed
+        self.pending = set()
+        self.prefetches = 0
+        self.skipped = 0
+
+    def on_expiring(self, key, hits):
+        if hits >= Prefetcher.MIN_HITS:
+            self.loop.call_soon_threadsafe(self._start, key)
+
+    def _start(self, key):
+        if key in self.pending:
+            return
+        if len(self.pending) >= self.max_parallel:
+            self.skipped += 1
+            return
+
+        self.pending.add(key)
+        self.prefetches += 1
+        self.loop.create_task(self._prefetch(key))
+
+    async def _prefetch(self, key):
+        try:
+            await self.resolve(Question(*key))
+        finally:
+            self.pending.discard(key)
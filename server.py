@@ -1,20 +1,29 @@
 import struct
 import socket
+import logging
+import random
 import selectors
-from dns_structs import (DNSPackage, Question,
+import heapq
+import time
+from dns_structs import (DNSPackage, Resolution,
+     MAX_PACKAGE_SIZE, EDNS_PAYLOAD,
      construct_query_from_questions,
-     construct_response_from_answers)
-from package_decode import decode_package
-from common import types, classes
+     construct_response_from_answers,
+     get_negative_soa)
+from package_decode import decode_package_lazy, fit_udp_response, DECODE_ERRORS
+from common import types, classes, rcodes
 from caching import Cache, CsvCacheManager
+from wire_cache import WireCache, get_max_bytes
+from upstream import (InfraCache, make_upstream_socket, random_query_id,
+     query_key, response_key)
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
 
 
 def log_rrs(rrs):
     for rr in rrs:
-        print(rr.__dict__)
-
-def get_parent_domain(domain_name):
-    return '.'.join(domain_name.split('.')[1:])
+        logger.debug('%s %s %s %s %s', rr.name, rr.tp, rr.cl, rr.ttl, rr.data)
 
 class CallbackData:
     def __init__(self, callback, *args, **kwargs):
@@ -24,9 +33,30 @@ class CallbackData:
 
 
 class QueryData:
-    def __init__(self, questions, answers):
+    def __init__(self, questions, answers, edns_payload=None, received_at=0.0):
+        self.questions = questions
+        self.received_at = received_at
+        # payload advertised by client
+        self.edns_payload = edns_payload
         self.remained_questions = set(questions)
         self.answers = answers
+        self.authorities = []
+        self.rcode = rcodes['NOERROR']
+
+
+class NsQueryData:
+    def __init__(self, client_query_id, client_addr, question, ns_addrs):
+        self.client_query_id = client_query_id
+        self.client_addr = client_addr
+        self.question = question
+        # servers to ask if current one does not answer, fastest first
+        self.ns_addrs = ns_addrs
+        self.ns_addr = None
+        self.query = None
+        self.attempt = 0
+        self.timeout = 0.0
+        self.sent_at = 0.0
+        self.deadline = 0.0
 
 
 class Server:
@@ -34,114 +64,241 @@ class Server:
     PORT = 53
     ROOT = '198.41.0.4'
 
-    def __init__(self, cache):
+    UPSTREAM_SOCKETS = 4
+    # sends to one server, and servers tried per question
+    ATTEMPTS = 2
+    MAX_SERVERS = 3
+
+    def __init__(self, cache, edns_payload=EDNS_PAYLOAD, metrics=None):
         self.server_sock = None
+        # UDP payload accepted from clients and servers, None disables EDNS0
+        self.edns_payload = edns_payload
+        self.upstream_socks = []
         self.selector = selectors.DefaultSelector()
         self.cache = cache
+        self.wire_cache = WireCache(cache.max_entries, get_max_bytes(cache.max_bytes))
         # (addr, ID) -> answers
         self.cached_answers_by_query = dict()
-        self.out_query_id_count = 0
+        self.infra = InfraCache()
+        # (query_id, ns_addr, (name, tp, cl)) -> NsQueryData
+        self.pending_ns_queries = dict()
+        # (deadline, key) of pending_ns_queries
+        self.ns_timeouts = []
         self.data_by_query = dict()
+        self.metrics = Metrics() if metrics is None else metrics
+        self.metrics.add_stats('dns_server', self.stats)
+        self.metrics.add_stats('dns_cache', self.cache.stats)
+
+    def stats(self):
+        return {
+            'active_queries': len(self.data_by_query),
+            'upstream_active_queries': len(self.pending_ns_queries),
+        }
 
     def run(self):
         self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.server_sock.bind((Server.LOCALHOST, Server.PORT))
         self.server_sock.setblocking(False)
-        print('DNS server listening on {0}:{1}'.format(Server.LOCALHOST, Server.PORT))
+        logger.info('DNS server listening on %s:%s', Server.LOCALHOST, Server.PORT)
         self.selector.register(self.server_sock, selectors.EVENT_READ, 
             CallbackData(self._serve_client))
+        for i in range(Server.UPSTREAM_SOCKETS):
+            sock_to_ns = make_upstream_socket()
+            self.upstream_socks.append(sock_to_ns)
+            self.selector.register(sock_to_ns, selectors.EVENT_READ,
+                CallbackData(self._receive_from_ns, sock_to_ns))
         
         while True:
-            events = self.selector.select(timeout=2)
+            timeout = 2
+            if len(self.ns_timeouts) > 0:
+                timeout = min(max(self.ns_timeouts[0][0] - time.monotonic(), 0), timeout)
+            events = self.selector.select(timeout=timeout)
             for key, _ in events:
                 payload = key.data
                 payload.callback(*payload.args, **payload.kwargs)
+            self._check_ns_timeouts()
     
     def _serve_client(self):
-        byte_query, client_addr = self.server_sock.recvfrom(1024)
-        print('Query from {0}:{1}'.format(*client_addr))
-        parsed_query = decode_package(byte_query)
-        self._process_query(client_addr, parsed_query)
+        byte_query, client_addr = self.server_sock.recvfrom(MAX_PACKAGE_SIZE)
+        received_at = time.monotonic()
+        logger.debug('Query from %s:%s', *client_addr)
+        self.metrics.queries.inc('udp')
+        try:
+            parsed_query = decode_package_lazy(byte_query)
+            # malformed packages are dropped here, before any state is kept
+            parsed_query.additions
+        except DECODE_ERRORS:
+            return
+        self._process_query(client_addr, parsed_query, received_at)
 
-    def _process_query(self, client_addr, query):
-        self.data_by_query[(client_addr, query.id)] = QueryData(query.questions, [])
+    def _process_query(self, client_addr, query, received_at):
+        if len(query.questions) == 1:
+            byte_response = self.wire_cache.find_response(query.id, query.questions[0])
+            if byte_response is not None:
+                logger.debug('Resolved from wire cache')
+                self.metrics.cache_hits.inc('wire')
+                self.server_sock.sendto(
+                    fit_udp_response(byte_response, query.edns_payload, self.edns_payload),
+                    client_addr)
+                self.metrics.count_response(byte_response, received_at, time.monotonic())
+                return
+
+        self.data_by_query[(client_addr, query.id)] = QueryData(
+            query.questions, [], query.edns_payload, received_at)
         for question in query.questions:
             self._process_question(client_addr, query.id, question)
 
     def _process_question(self, client_addr, query_id, question):
-        print('Question is {}'.format(question.__dict__))
+        logger.debug('Question is %s %s %s', question.name, question.tp, question.cl)
         answers = self.cache.find_answers(question)
-        ns_address = self._find_nearest_ns(question.name)
-
+        negative = self.cache.find_negative(question) if len(answers) == 0 else None
         if len(answers) != 0:
-            self._set_question_as_answered(client_addr, query_id, question, answers)
+            self.metrics.cache_hits.inc('records')
+            self._set_question_as_answered(
+                client_addr, query_id, question, Resolution(answers))
+        elif negative is not None:
+            self.metrics.cache_hits.inc('negative')
+            rcode, soa = negative
+            self._set_question_as_answered(
+                client_addr, query_id, question, Resolution([], rcode, [soa]))
         else:
-            self._query_ns(query_id, client_addr, ns_address, question)
+            self.metrics.cache_misses.inc()
+            ns_addresses = self._find_nearest_ns(question.name)
+            self._query_ns(query_id, client_addr, ns_addresses, question)
 
     def _find_nearest_ns(self, question_name):
-        domain = get_parent_domain(question_name)
-        while domain != '':
-            q = Question(domain, types['A'], 1)
-            answers = self.cache.find_answers(q)
-            if len(answers) > 0:
-                return answers[0].data
-            domain = get_parent_domain(domain)
-
-        return Server.ROOT
-
-    def _query_ns(self, client_query_id, client_addr, ns_address, question):
-        sock_to_ns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock_to_ns.setblocking(False)
-        sock_to_ns.bind(('', 0))
-        
-        self.out_query_id_count += 1
-        self.out_query_id_count %= 1 << 16
-        query_to_ns = construct_query_from_questions(
-            self.out_query_id_count, [question])
-        print('Query ns {0} with ID = {1}'.format(ns_address, self.out_query_id_count))
-        print('VIA socket {}'.format(sock_to_ns.getsockname())) 
-        
-        sock_to_ns.sendto(query_to_ns.to_bytes(), (ns_address, Server.PORT))
-        self.selector.register(sock_to_ns, selectors.EVENT_READ, 
-            CallbackData(
-                self._process_answer_from_ns, sock_to_ns, 
-                client_query_id, client_addr, question))
-
-    def _process_answer_from_ns(self, sock_to_ns, client_query_id, client_addr, question):
-        byte_response, _ = sock_to_ns.recvfrom(1024)
-        parsed_response = decode_package(byte_response)
+        ns_addresses = self.cache.delegations.find_nearest(question_name, time.monotonic())
+        if len(ns_addresses) > 0:
+            return ns_addresses
+
+        return [Server.ROOT]
+
+    def _query_ns(self, client_query_id, client_addr, ns_addresses, question):
+        ns_addrs = self.infra.rank(
+            [(ns_address, Server.PORT) for ns_address in ns_addresses])
+        ns_query = NsQueryData(client_query_id, client_addr, question,
+            ns_addrs[:Server.MAX_SERVERS])
+        self._ask_next_ns(ns_query)
+
+    def _ask_next_ns(self, ns_query):
+        if len(ns_query.ns_addrs) == 0:
+            logger.debug('No nameserver answered')
+            self._set_question_as_answered(
+                ns_query.client_addr, ns_query.client_query_id, ns_query.question,
+                Resolution([], rcodes['SERVFAIL']))
+            return
+
+        ns_query.ns_addr = ns_query.ns_addrs.pop(0)
+        key = query_key(random_query_id(), ns_query.ns_addr, ns_query.question)
+        while key in self.pending_ns_queries:
+            key = query_key(random_query_id(), ns_query.ns_addr, ns_query.question)
+        self.pending_ns_queries[key] = ns_query
+
+        ns_query.query = construct_query_from_questions(
+            key[0], [ns_query.question], self.edns_payload).to_bytes()
+        ns_query.attempt = 0
+        ns_query.timeout = self.infra.timeout(ns_query.ns_addr)
+        logger.debug('Query ns %s with ID = %s', ns_query.ns_addr[0], key[0])
+        self._send_ns_query(key, ns_query)
+
+    def _send_ns_query(self, key, ns_query):
+        sock_to_ns = random.choice(self.upstream_socks)
+        sock_to_ns.sendto(ns_query.query, ns_query.ns_addr)
+        self.metrics.upstream_queries.inc('udp')
+        ns_query.sent_at = time.monotonic()
+        ns_query.deadline = ns_query.sent_at + ns_query.timeout
+        heapq.heappush(self.ns_timeouts, (ns_query.deadline, key))
+
+    def _check_ns_timeouts(self):
+        now = time.monotonic()
+        while len(self.ns_timeouts) > 0 and self.ns_timeouts[0][0] <= now:
+            deadline, key = heapq.heappop(self.ns_timeouts)
+            ns_query = self.pending_ns_queries.get(key)
+            if ns_query is None or ns_query.deadline != deadline:
+                continue
+
+            if ns_query.attempt + 1 < Server.ATTEMPTS:
+                # retransmit with doubled timeout
+                ns_query.attempt += 1
+                ns_query.timeout = min(ns_query.timeout * 2, InfraCache.MAX_TIMEOUT)
+                self._send_ns_query(key, ns_query)
+                continue
+
+            logger.debug('Timeout of %s:%s', *ns_query.ns_addr)
+            self.metrics.upstream_timeouts.inc()
+            del self.pending_ns_queries[key]
+            self.infra.record_timeout(ns_query.ns_addr)
+            self._ask_next_ns(ns_query)
+
+    def _receive_from_ns(self, sock_to_ns):
+        byte_response, ns_addr = sock_to_ns.recvfrom(MAX_PACKAGE_SIZE)
+        try:
+            parsed_response = decode_package_lazy(byte_response)
+            parsed_response.additions
+        except DECODE_ERRORS:
+            return
+        ns_query = self.pending_ns_queries.pop(response_key(parsed_response, ns_addr), None)
+        if ns_query is None:
+            return
+
+        # rtt of retransmitted query is ambiguous
+        rtt = time.monotonic() - ns_query.sent_at if ns_query.attempt == 0 else None
+        self.infra.record_response(ns_addr, rtt)
+        if rtt is not None:
+            self.metrics.upstream_latency.observe(rtt)
+        self._process_answer_from_ns(parsed_response,
+            ns_query.client_query_id, ns_query.client_addr, ns_query.question)
+
+    def _process_answer_from_ns(self, parsed_response, client_query_id, client_addr, question):
         answers = list(self._filter_supported_records(parsed_response.answers))
         authorities = list(self._filter_supported_records(parsed_response.authorities))
         additions = list(self._filter_supported_records(parsed_response.additions))
 
-        print('Got {0} answers from forwarder'.format(len(parsed_response.answers)))
-        log_rrs(parsed_response.answers)
-        print('Got {0} authorities from forwarder'.format(len(parsed_response.authorities)))
-        log_rrs(parsed_response.authorities)
-        print('Got {0} additions from forwarder'.format(len(parsed_response.additions)))
-        log_rrs(parsed_response.additions)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Got %s answers from forwarder', len(parsed_response.answers))
+            log_rrs(parsed_response.answers)
+            logger.debug('Got %s authorities from forwarder', len(parsed_response.authorities))
+            log_rrs(parsed_response.authorities)
+            logger.debug('Got %s additions from forwarder', len(parsed_response.additions))
+            log_rrs(parsed_response.additions)
 
         records_to_cache = answers + authorities + additions
         for record in records_to_cache:
             self.cache.add_answer(record)
 
-        self.selector.unregister(sock_to_ns)
+        soa = get_negative_soa(authorities)
         if len(answers) != 0: 
             # ns answered
-            self._set_question_as_answered(client_addr, client_query_id, question, parsed_response.answers)
-            print('Sucessful')
+            self._set_question_as_answered(client_addr, client_query_id, question,
+                Resolution(parsed_response.answers))
+            logger.debug('Sucessful')
+        elif parsed_response.rcode == rcodes['NXDOMAIN'] or len(soa) > 0:
+            # name or record of asked type does not exist
+            rcode = parsed_response.rcode
+            if rcode in (rcodes['NOERROR'], rcodes['NXDOMAIN']) and len(soa) > 0:
+                self.cache.add_negative(question, rcode, soa[0])
+            self._set_question_as_answered(client_addr, client_query_id, question,
+                Resolution([], rcode, soa[:1]))
+            logger.debug('Negative')
         elif len(additions) > 0:
-            # ns delegates
-            next_ns = additions[0].data
+            # ns delegates, glue of its nameservers is used
+            ns_names = set(record.data for record in authorities if record.tp == types['NS'])
+            next_ns = [
+                record.data for record in additions
+                if record.tp == types['A'] and record.name in ns_names]
             self._query_ns(client_query_id, client_addr, next_ns, question)
-            print('Delegation')
+            logger.debug('Delegation')
         else:
-            self._set_question_as_answered(client_addr, client_query_id, question, parsed_response.answers)
-            print('Unsuccessful')
+            self._set_question_as_answered(client_addr, client_query_id, question,
+                Resolution([], parsed_response.rcode))
+            logger.debug('Unsuccessful')
             
-    def _set_question_as_answered(self, client_addr, query_id, question, answers):
+    def _set_question_as_answered(self, client_addr, query_id, question, resolution):
         quety_data = self.data_by_query[(client_addr, query_id)]
-        quety_data.answers += answers
+        quety_data.answers += resolution.answers
+        quety_data.authorities += resolution.authorities
+        if quety_data.rcode == rcodes['NOERROR']:
+            quety_data.rcode = resolution.rcode
         quety_data.remained_questions.remove(question)
 
         if len(quety_data.remained_questions) == 0:
@@ -153,6 +310,14 @@ class Server:
                 yield record
     
     def _respond_to_client(self, client_addr, query_id):
-        answers = self.data_by_query[(client_addr, query_id)].answers
-        dns_response = construct_response_from_answers(query_id, answers)
-        self.server_sock.sendto(dns_response.to_bytes(), client_addr)
+        query_data = self.data_by_query.pop((client_addr, query_id))
+        dns_response = construct_response_from_answers(
+            query_id, query_data.answers, query_data.rcode, query_data.authorities)
+        byte_response = dns_response.to_bytes()
+        if (len(query_data.questions) == 1 and query_data.rcode != rcodes['SERVFAIL']
+                and len(query_data.answers) + len(query_data.authorities) > 0):
+            self.wire_cache.add_response(query_data.questions[0], byte_response)
+        self.server_sock.sendto(
+            fit_udp_response(byte_response, query_data.edns_payload, self.edns_payload),
+            client_addr)
+        self.metrics.count_response(byte_response, query_data.received_at, time.monotonic())
@@ -0,0 +1,129 @@
+import time
+from threading import Lock
+from caching import Cache, synchronized
+from common import types
+from delegation import DelegationIndex
+from dns_structs import Answer
+
+
+class CacheShard(Cache):
+    '''
+        Part of ShardedCache. Answers are found without taking the lock,
+        as lists of records are replaced on change. Recency and hits
+        are updated only if the lock is free at the moment.
+    '''
+    def __init__(self, max_entries=None, max_bytes=None, stale_window=0, delegations=None):
+        super().__init__(max_entries, max_bytes, stale_window)
+        if delegations is not None:
+            self.delegations = delegations
+        # class method finds answers without lock
+        del self.find_answers
+
+    def find_answers(self, question):
+        key = (question.name, question.tp, question.cl)
+        records = self.cache.get(key)
+        if records is None:
+            return []
+
+        now = time.monotonic()
+        # expired records are removed by writers
+        result = [Answer(key[0], key[1], key[2], int(record.expires_at - now), rdata=record.data)
+            for record in records if now < record.expires_at]
+        if len(result) > 0 and self.cache_lock.acquire(blocking=False):
+            try:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    if self.on_expiring is not None:
+                        self._count_hit(key, now)
+            finally:
+                self.cache_lock.release()
+        return result
+
+
+class ShardedCache:
+    '''
+        Cache split into shards by name, each with its own lock, so threads
+        working with different names do not wait for each other.
+        Shards share delegation index guarded by its own lock,
+        limits of entries and bytes are split evenly between shards.
+    '''
+    def __init__(self, shards=16, max_entries=None, max_bytes=None, stale_window=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_window = stale_window
+
+        self.delegations = DelegationIndex()
+        self.delegations_lock = Lock()
+        for method in ('add_ns', 'remove_ns', 'add_address', 'remove_address', 'find_nearest'):
+            setattr(self.delegations, method,
+                synchronized(self.delegations_lock)(getattr(self.delegations, method)))
+
+        self.shards = [
+            CacheShard(self._split(max_entries, shards), self._split(max_bytes, shards),
+                stale_window, self.delegations)
+            for i in range(shards)]
+
+    @staticmethod
+    def _split(limit, shards):
+        return None if limit is None else max(1, -(-limit // shards))
+
+    @property
+    def journal(self):
+        return self.shards[0].journal
+
+    @journal.setter
+    def journal(self, journal):
+        for shard in self.shards:
+            shard.journal = journal
+
+    @property
+    def on_expiring(self):
+        return self.shards[0].on_expiring
+
+    @on_expiring.setter
+    def on_expiring(self, on_expiring):
+        for shard in self.shards:
+            shard.on_expiring = on_expiring
+
+    def stats(self):
+        stats = dict()
+        for shard in self.shards:
+            for name, value in shard.stats().items():
+                stats[name] = stats.get(name, 0) + value
+        stats['shards'] = len(self.shards)
+        return stats
+
+    def get_shard(self, name):
+        return self.shards[hash(name) % len(self.shards)]
+
+    def add_answer(self, answer, expires_at=None):
+        self.get_shard(answer.name).add_answer(answer, expires_at)
+
+    def find_answers(self, question):
+        return self.get_shard(question.name).find_answers(question)
+
+    def find_stale_answers(self, question):
+        return self.get_shard(question.name).find_stale_answers(question)
+
+    def add_negative(self, question, rcode, soa):
+        self.get_shard(question.name).add_negative(question, rcode, soa)
+
+    def find_negative(self, question):
+        return self.get_shard(question.name).find_negative(question)
+
+    def load_records(self, records):
+        # nameservers of all shards go first for their addresses to be indexed
+        records = list(records)
+        for nameservers in (True, False):
+            parts = [[] for shard in self.shards]
+            for key, items in records:
+                if (key[1] == types['NS']) == nameservers:
+                    parts[hash(key[0]) % len(self.shards)].append((key, items))
+            for shard, part in zip(self.shards, parts):
+                shard.load_records(part)
+
+    def get_records(self):
+        # shards are copied one at a time, each under its own lock
+        for shard in self.shards:
+            for key, records in shard.get_records():
+                yield key, records
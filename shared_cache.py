@@ -0,0 +1,354 @@
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from multiprocessing import Lock as ProcessLock
+from caching import Cache, CacheItem, STALE_TTL
+from dns_structs import Answer, Question, rdata_to_bytes, rdata_from_bytes
+from common import types
+from delegation import DelegationIndex
+
+TABLE_HEADER = struct.Struct('!4sHHI')
+# seq, key hash, expires_at, key length, value length
+SLOT_HEADER = struct.Struct('!IIdHH')
+SEQ = struct.Struct('!I')
+KEY_TAIL = struct.Struct('!HH')
+# expires_at, ttl, data length
+RECORD_HEADER = struct.Struct('!dIH')
+
+
+class SharedTable:
+    '''
+        Fixed-size open addressing hash table in shared memory or mmap file.
+        Each slot keeps one value, writers take striped process locks,
+        readers take no locks and retry on slot sequence change (seqlock).
+        Must be created before workers are forked.
+    '''
+    MAGIC = b'DNSS'
+    VERSION = 1
+    # slots looked through for a key
+    PROBES = 8
+    READ_ATTEMPTS = 4
+
+    def __init__(self, slots, slot_size=512, file_name=None, locks=64):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.size = TABLE_HEADER.size + slots * slot_size
+        self.locks = [ProcessLock() for i in range(locks)]
+        self.evictions = 0
+
+        header = TABLE_HEADER.pack(SharedTable.MAGIC, SharedTable.VERSION, slot_size, slots)
+        if file_name is None:
+            # anonymous mapping is shared with forked processes
+            self.memory = mmap.mmap(-1, self.size)
+        else:
+            fd = os.open(file_name, os.O_RDWR | os.O_CREAT)
+            try:
+                if os.fstat(fd).st_size != self.size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self.size)
+                self.memory = mmap.mmap(fd, self.size)
+            finally:
+                os.close(fd)
+
+        if self.memory[:TABLE_HEADER.size] != header:
+            self.memory[:] = bytes(self.size)
+            self.memory[:TABLE_HEADER.size] = header
+
+    def read(self, key):
+        # returns value or None
+        key_hash = zlib.crc32(key)
+        for probe in range(SharedTable.PROBES):
+            value = self._read_slot(self._slot_offset(key_hash + probe), key, key_hash)
+            if value is not None:
+                return value
+        return None
+
+    def update(self, key, merge, now):
+        # merge(old value or None) -> (new value, expires_at) is called under slot lock
+        key_hash = zlib.crc32(key)
+        for attempt in range(SharedTable.PROBES):
+            index = self._choose_slot(key, key_hash, now)
+            offset = self._slot_offset(index)
+            with self.locks[index % len(self.locks)]:
+                _, slot_hash, expires_at, key_len, value_len = \
+                    SLOT_HEADER.unpack_from(self.memory, offset)
+                data_offset = offset + SLOT_HEADER.size
+                same_key = slot_hash == key_hash and \
+                    self.memory[data_offset:data_offset + key_len] == key
+                if not same_key and key_len != 0 and expires_at > now \
+                        and index != self._choose_slot(key, key_hash, now):
+                    # slot was taken by another writer, choose again
+                    continue
+
+                old_value = None
+                if same_key:
+                    old_value = self.memory[data_offset + key_len:data_offset + key_len + value_len]
+                elif key_len != 0 and expires_at > now:
+                    self.evictions += 1
+                value, expires_at = merge(old_value)
+                if SLOT_HEADER.size + len(key) + len(value) > self.slot_size:
+                    return False
+                self._write_slot(offset, key, key_hash, value, expires_at)
+                return True
+        return False
+
+    def items(self):
+        # (key, value) of all occupied slots
+        for index in range(self.slots):
+            offset = self._slot_offset(index)
+            for attempt in range(SharedTable.READ_ATTEMPTS):
+                seq, _, _, key_len, value_len = SLOT_HEADER.unpack_from(self.memory, offset)
+                if seq & 1:
+                    continue
+                data_offset = offset + SLOT_HEADER.size
+                data = self.memory[data_offset:data_offset + key_len + value_len]
+                if SEQ.unpack_from(self.memory, offset)[0] != seq:
+                    continue
+                if key_len != 0:
+                    yield data[:key_len], data[key_len:]
+                break
+
+    def count(self):
+        return sum(1 for item in self.items())
+
+    def _slot_offset(self, index):
+        return TABLE_HEADER.size + (index % self.slots) * self.slot_size
+
+    def _read_slot(self, offset, key, key_hash):
+        for attempt in range(SharedTable.READ_ATTEMPTS):
+            seq, slot_hash, _, key_len, value_len = SLOT_HEADER.unpack_from(self.memory, offset)
+            if seq & 1:
+                # being written
+                continue
+            if slot_hash != key_hash or key_len != len(key):
+                return None
+            data_offset = offset + SLOT_HEADER.size
+            data = self.memory[data_offset:data_offset + key_len + value_len]
+            if SEQ.unpack_from(self.memory, offset)[0] != seq:
+                continue
+            if data[:key_len] != key:
+                return None
+            return data[key_len:]
+        return None
+
+    def _choose_slot(self, key, key_hash, now):
+        # slot with the same key, else free or expired one, else the soonest to expire
+        victim = None
+        victim_expires_at = None
+        for probe in range(SharedTable.PROBES):
+            index = (key_hash + probe) % self.slots
+            offset = self._slot_offset(index)
+            _, slot_hash, expires_at, key_len, _ = SLOT_HEADER.unpack_from(self.memory, offset)
+            data_offset = offset + SLOT_HEADER.size
+            if slot_hash == key_hash and self.memory[data_offset:data_offset + key_len] == key:
+                return index
+            if victim is not None and victim_expires_at <= now:
+                continue
+            if key_len == 0 or expires_at <= now:
+                victim, victim_expires_at = index, now
+            elif victim is None or expires_at < victim_expires_at:
+                victim, victim_expires_at = index, expires_at
+        return victim
+
+    def _write_slot(self, offset, key, key_hash, value, expires_at):
+        seq = SEQ.unpack_from(self.memory, offset)[0]
+        SLOT_HEADER.pack_into(self.memory, offset,
+            seq + 1, key_hash, expires_at, len(key), len(value))
+        data_offset = offset + SLOT_HEADER.size
+        self.memory[data_offset:data_offset + len(key)] = key
+        self.memory[data_offset + len(key):data_offset + len(key) + len(value)] = value
+        SEQ.pack_into(self.memory, offset, (seq + 2) & 0xFFFFFFFF)
+
+
+def encode_key(name, tp, cl):
+    return name.encode('utf-8') + KEY_TAIL.pack(tp, cl)
+
+
+def decode_key(key):
+    tp, cl = KEY_TAIL.unpack_from(key, len(key) - KEY_TAIL.size)
+    return sys.intern(key[:-KEY_TAIL.size].decode('utf-8')), tp, cl
+
+
+def encode_records(records):
+    # records are (expires_at, ttl, data)
+    return b''.join(
+        RECORD_HEADER.pack(expires_at, ttl, len(data)) + data
+        for expires_at, ttl, data in records)
+
+
+def decode_records(value):
+    records = []
+    offset = 0
+    while offset < len(value):
+        expires_at, ttl, data_len = RECORD_HEADER.unpack_from(value, offset)
+        offset += RECORD_HEADER.size
+        records.append((expires_at, ttl, bytes(value[offset:offset + data_len])))
+        offset += data_len
+    return records
+
+
+class SharedCache(Cache):
+    '''
+        Cache keeping RRsets in SharedTable, so forked workers share them.
+        Expiry times in table are wall clock ones to mean the same in every process.
+        Negative answers and delegation index stay per process,
+        the index is limited by number of table slots.
+    '''
+    def __init__(self, table, max_entries=None, max_bytes=None, stale_window=0):
+        super().__init__(max_entries, max_bytes, stale_window)
+        self.table = table
+        self.delegations = DelegationIndex(table.slots)
+
+    def stats(self):
+        stats = super().stats()
+        stats['entries'] = self.table.count()
+        stats['evictions'] += self.table.evictions
+        return stats
+
+    def add_answer(self, answer, expires_at=None):
+        now = time.monotonic()
+        if expires_at is None:
+            expires_at = now + answer.ttl
+        self._index_delegation(answer.name, answer.tp, answer.rdata, expires_at)
+        if expires_at + self.stale_window <= now:
+            return
+        if self.journal is not None:
+            self.journal.append(answer, expires_at)
+
+        wall_now = time.time()
+        new_record = (wall_now + expires_at - now, answer.ttl,
+            rdata_to_bytes(answer.tp, answer.rdata))
+
+        def merge(value):
+            # slot is taken until its records leave stale window
+            records = [] if value is None else [
+                record for record in decode_records(value)
+                if record[0] + self.stale_window > wall_now]
+            for i in range(len(records)):
+                if records[i][2] == new_record[2]:
+                    if new_record[0] > records[i][0]:
+                        records[i] = new_record
+                    break
+            else:
+                records.append(new_record)
+            return encode_records(records), \
+                max(record[0] for record in records) + self.stale_window
+
+        self.table.update(encode_key(answer.name, answer.tp, answer.cl), merge, wall_now)
+
+    def load_records(self, records):
+        # nameservers go first for their addresses to be indexed
+        records = sorted(records, key=lambda record: record[0][1] != types['NS'])
+        for (name, tp, cl), items in records:
+            for item in items:
+                self.add_answer(Answer(name, tp, cl, item.ttl, rdata=item.data), item.expires_at)
+
+    def find_answers(self, question):
+        value = self.table.read(encode_key(question.name, question.tp, question.cl))
+        if value is None:
+            return []
+
+        now = time.time()
+        return [
+            Answer(question.name, question.tp, question.cl,
+                int(expires_at - now), rdata=rdata_from_bytes(question.tp, data))
+            for expires_at, ttl, data in decode_records(value) if now < expires_at]
+
+    def find_stale_answers(self, question):
+        value = self.table.read(encode_key(question.name, question.tp, question.cl))
+        if value is None:
+            return []
+
+        now = time.time()
+        return [
+            Answer(question.name, question.tp, question.cl,
+                STALE_TTL, rdata=rdata_from_bytes(question.tp, data))
+            for expires_at, ttl, data in decode_records(value)
+            if now < expires_at + self.stale_window]
+
+    def get_records(self):
+        wall_now = time.time()
+        now = time.monotonic()
+        records = []
+        for key, value in self.table.items():
+            name, tp, cl = decode_key(key)
+            records.append(((name, tp, cl), [
+                CacheItem(rdata_from_bytes(tp, data), ttl, now + expires_at - wall_now)
+                for expires_at, ttl, data in decode_records(value)
+                if expires_at + self.stale_window > wall_now]))
+        return records
+
+
+def shared_table_test_read_write():
+    table = SharedTable(64, slot_size=128)
+    now = time.time()
+    assert table.read(b'key') is None
+    assert table.update(b'key', lambda old: (b'value', now + 60), now)
+    assert bytes(table.read(b'key')) == b'value'
+    # merge gets the old value
+    assert table.update(b'key', lambda old: (bytes(old) + b'2', now + 60), now)
+    assert bytes(table.read(b'key')) == b'value2'
+    # too large values are not written
+    assert not table.update(b'other', lambda old: (bytes(128), now + 60), now)
+    assert table.read(b'other') is None
+    assert [(bytes(key), bytes(value)) for key, value in table.items()] == [(b'key', b'value2')]
+
+    # value written by forked worker is read by parent
+    pid = os.fork()
+    if pid == 0:
+        table.update(b'child', lambda old: (b'from child', now + 60), now)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert bytes(table.read(b'child')) == b'from child'
+
+
+def shared_table_test_file():
+    # table in file keeps values for the next process
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'cache.table')
+        now = time.time()
+        SharedTable(64, file_name=file_name).update(
+            b'key', lambda old: (b'value', now + 60), now)
+        assert bytes(SharedTable(64, file_name=file_name).read(b'key')) == b'value'
+        # table of other size is cleared
+        assert SharedTable(32, file_name=file_name).read(b'key') is None
+
+
+def shared_cache_test_answers():
+    cache = SharedCache(SharedTable(64))
+    answers = [
+        Answer('google.com.', types['A'], 1, 300, '10.0.0.1'),
+        Answer('google.com.', types['A'], 1, 300, '10.0.0.2'),
+        Answer('google.com.', types['AAAA'], 1, 300, '2001:db8::1'),
+        Answer('google.com.', types['NS'], 1, 300, 'ns1.google.com.'),
+        Answer('google.com.', 16, 1, 300, rdata=b'\x04\x98\xff\x00a'),
+    ]
+    for answer in answers:
+        cache.add_answer(answer)
+    for answer in answers:
+        found = cache.find_answers(Question(answer.name, answer.tp, answer.cl))
+        assert answer.data in [found_answer.data for found_answer in found], answer.__dict__
+    assert sorted(key for key, items in cache.get_records()) == [
+        ('google.com.', types['A'], 1), ('google.com.', types['NS'], 1),
+        ('google.com.', 16, 1), ('google.com.', types['AAAA'], 1)]
+
+
+
+def shared_cache_test_stale():
+    cache = SharedCache(SharedTable(64), stale_window=60)
+    question = Question('google.com.', types['A'], 1)
+    cache.add_answer(Answer('google.com.', types['A'], 1, 300, '10.0.0.1'), time.monotonic() - 1)
+    assert cache.find_answers(question) == []
+    assert [answer.data for answer in cache.find_stale_answers(question)] == ['10.0.0.1']
+    assert len(cache.get_records()[0][1]) == 1
+
+
+if __name__ == "__main__":
+    shared_table_test_read_write()
+    shared_table_test_file()
+    shared_cache_test_answers()
+    shared_cache_test_stale()
@@ -0,0 +1,198 @@
+import logging
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from caching import Cache, CacheItem
+from common import types
+from dns_structs import Answer, Question, rdata_to_bytes, rdata_from_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class CacheJournal:
+    '''
+        Append-only log of records added to cache since the last snapshot.
+        Replayed over the snapshot on start, so restart after crash stays warm.
+    '''
+    MAGIC = b'DNSJ'
+    VERSION = 1
+    HEADER = struct.Struct('!4sH')
+    # expires_at (wall clock), tp, cl, ttl, name length, data length
+    ENTRY = struct.Struct('!dHHIHH')
+    # buffered entries are written at least that often by Snapshotter, seconds
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.rotated_file_name = file_name + '.old'
+        self.journal_lock = threading.Lock()
+        self.journal = self._open()
+
+    def append(self, answer, expires_at):
+        now = time.monotonic()
+        if expires_at <= now:
+            return
+
+        name = answer.name.encode('utf-8')
+        data = rdata_to_bytes(answer.tp, answer.rdata)
+        entry = CacheJournal.ENTRY.pack(time.time() + expires_at - now,
+            answer.tp, answer.cl, answer.ttl, len(name), len(data)) + name + data
+        with self.journal_lock:
+            self.journal.write(entry)
+
+    def flush(self):
+        with self.journal_lock:
+            self.journal.flush()
+
+    def rotate(self):
+        # entries logged from now on are not in the snapshot being taken
+        with self.journal_lock:
+            if os.path.exists(self.rotated_file_name):
+                # left by failed snapshot, its entries are kept until one succeeds,
+                # journal is not rotated and the snapshot covers it too
+                self.journal.flush()
+                return
+            self.journal.close()
+            os.replace(self.file_name, self.rotated_file_name)
+            self.journal = self._open()
+
+    def remove_rotated(self):
+        if os.path.exists(self.rotated_file_name):
+            os.remove(self.rotated_file_name)
+
+    def close(self):
+        with self.journal_lock:
+            self.journal.close()
+
+    def _open(self):
+        journal = open(self.file_name, 'ab')
+        if journal.tell() == 0:
+            journal.write(CacheJournal.HEADER.pack(CacheJournal.MAGIC, CacheJournal.VERSION))
+        return journal
+
+    @staticmethod
+    def replay(file_name, cache):
+        # rotated journal is left if process died during snapshot
+        for journal_file in (file_name + '.old', file_name):
+            if os.path.exists(journal_file):
+                records = CacheJournal._read_records(journal_file, cache.stale_window)
+                cache.load_records(records.items())
+        return cache
+
+    @staticmethod
+    def _read_records(file_name, stale_window):
+        with open(file_name, 'rb') as journal:
+            data = journal.read()
+
+        records = OrderedDict()
+        if len(data) < CacheJournal.HEADER.size:
+            return records
+        magic, version = CacheJournal.HEADER.unpack_from(data, 0)
+        if magic != CacheJournal.MAGIC or version != CacheJournal.VERSION:
+            raise ValueError('Unsupported cache journal version {}'.format(version))
+
+        now = time.time()
+        monotonic_now = time.monotonic()
+        offset = CacheJournal.HEADER.size
+        while offset + CacheJournal.ENTRY.size <= len(data):
+            expires_at, tp, cl, ttl, name_length, data_length = \
+                CacheJournal.ENTRY.unpack_from(data, offset)
+            offset += CacheJournal.ENTRY.size
+            if offset + name_length + data_length > len(data):
+                # entry was cut by crash
+                break
+            name = sys.intern(data[offset:offset + name_length].decode('utf-8'))
+            offset += name_length
+            record_data = rdata_from_bytes(tp, data[offset:offset + data_length])
+            offset += data_length
+            if expires_at + stale_window > now:
+                records.setdefault((name, tp, cl), []).append(
+                    CacheItem(record_data, ttl, monotonic_now + expires_at - now))
+        return records
+
+
+class Snapshotter:
+    '''
+        Saves cache every interval seconds from a background thread.
+        File is written aside and renamed over the old one,
+        so a crash never leaves it half written.
+    '''
+    def __init__(self, cache, file_name, cache_manager, interval=None, journal=None):
+        self.cache = cache
+        self.file_name = file_name
+        self.cache_manager = cache_manager
+        self.interval = interval
+        self.journal = journal
+        self.snapshots = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.interval is not None or self.journal is not None:
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def snapshot(self):
+        if self.journal is not None:
+            self.journal.rotate()
+        temp_file_name = '{}.tmp'.format(self.file_name)
+        self.cache_manager.save_cache_to(self.cache, temp_file_name)
+        os.replace(temp_file_name, self.file_name)
+        if self.journal is not None:
+            self.journal.remove_rotated()
+        self.snapshots += 1
+
+    def _run(self):
+        tick = self.interval
+        if self.journal is not None:
+            tick = min(CacheJournal.FLUSH_INTERVAL, self.interval or CacheJournal.FLUSH_INTERVAL)
+        next_snapshot_at = None
+        if self.interval is not None:
+            next_snapshot_at = time.monotonic() + self.interval
+
+        while not self.stopped.wait(tick):
+            try:
+                if self.journal is not None:
+                    self.journal.flush()
+                if next_snapshot_at is not None and time.monotonic() >= next_snapshot_at:
+                    self.snapshot()
+                    next_snapshot_at = time.monotonic() + self.interval
+            except Exception:
+                logger.exception('Cache snapshot failed')
+
+
+def journal_test_round_trip():
+    answers = [
+        Answer('google.com.', types['A'], 1, 300, '10.0.0.1'),
+        Answer('google.com.', types['AAAA'], 1, 300, '2001:db8::1'),
+        Answer('google.com.', types['NS'], 1, 3600, 'ns1.google.com.'),
+        Answer('google.com.', 16, 1, 300, rdata=b'\x04\x98\xff\x00a'),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'cache.journal')
+        journal = CacheJournal(file_name)
+        cache = Cache()
+        cache.journal = journal
+        for answer in answers:
+            cache.add_answer(answer)
+        journal.close()
+        # entry cut by crash is skipped
+        with open(file_name, 'ab') as journal_file:
+            journal_file.write(CacheJournal.ENTRY.pack(time.time() + 300, 1, 1, 300, 20, 4))
+
+        loaded = CacheJournal.replay(file_name, Cache())
+    for answer in answers:
+        found = loaded.find_answers(Question(answer.name, answer.tp, answer.cl))
+        assert [found_answer.data for found_answer in found] == [answer.data], answer.__dict__
+
+
+if __name__ == "__main__":
+    journal_test_round_trip()
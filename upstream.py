@@ -0,0 +1,419 @@
+import asyncio
+import logging
+import random
+import socket
+import time
+from dns_structs import construct_query_from_questions, RDLEN, EDNS_PAYLOAD
+from package_decode import decode_package_lazy, DECODE_ERRORS
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+system_random = random.SystemRandom()
+
+
+def make_upstream_socket(attempts=10):
+    # nonblocking UDP socket bound to a random source port
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for i in range(attempts):
+        try:
+            sock.bind(('', system_random.randrange(1024, 1 << 16)))
+            break
+        except OSError:
+            continue
+    else:
+        sock.bind(('', 0))
+    sock.setblocking(False)
+    return sock
+
+
+def random_query_id():
+    return system_random.getrandbits(16)
+
+
+def decode_response(data):
+    # response with all sections decoded, None if package is malformed
+    try:
+        response = decode_package_lazy(data)
+        response.additions
+    except DECODE_ERRORS:
+        return None
+    return response
+
+
+def response_key(response, addr):
+    # key to match response with query
+    if len(response.questions) != 1:
+        return None
+    question = response.questions[0]
+    return (response.id, addr, (question.name, question.tp, question.cl))
+
+
+def query_key(query_id, addr, question):
+    return (query_id, addr, (question.name, question.tp, question.cl))
+
+
+class ServerStats:
+    __slots__ = ('srtt', 'rttvar', 'failures', 'retry_at')
+
+    def __init__(self):
+        # smoothed round trip time and its variation, None until first sample
+        self.srtt = None
+        self.rttvar = None
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class InfraCache:
+    '''
+        Smoothed RTT and failure counts of upstream servers (RFC 6298 style),
+        used to choose the fastest responsive server and to back off dead ones.
+    '''
+    # assumed rtt of never asked server, slower known servers lose to it
+    INITIAL_RTT = 0.4
+    MIN_TIMEOUT = 0.1
+    MAX_TIMEOUT = 3.0
+    MAX_BACKOFF = 300
+    MIN_RACE_DELAY = 0.02
+
+    def __init__(self):
+        # (ip, port) -> ServerStats
+        self.servers = dict()
+
+    def timeout(self, addr):
+        stats = self.servers.get(addr)
+        if stats is None or stats.srtt is None:
+            return InfraCache.INITIAL_RTT * 2
+        rto = stats.srtt + 4 * stats.rttvar
+        return min(max(rto, InfraCache.MIN_TIMEOUT), InfraCache.MAX_TIMEOUT)
+
+    def race_delay(self, addr):
+        # how long to wait for server before asking the next one in parallel
+        stats = self.servers.get(addr)
+        if stats is None or stats.srtt is None:
+            return InfraCache.INITIAL_RTT / 2
+        delay = stats.srtt + 2 * stats.rttvar
+        return min(max(delay, InfraCache.MIN_RACE_DELAY), self.timeout(addr))
+
+    def record_response(self, addr, rtt=None):
+        stats = self._get_stats(addr)
+        if rtt is None:
+            pass
+        elif stats.srtt is None:
+            stats.srtt = rtt
+            stats.rttvar = rtt / 2
+        else:
+            stats.rttvar = 0.75 * stats.rttvar + 0.25 * abs(stats.srtt - rtt)
+            stats.srtt = 0.875 * stats.srtt + 0.125 * rtt
+        stats.failures = 0
+        stats.retry_at = 0.0
+
+    def record_late(self, addr, elapsed):
+        # query was abandoned after elapsed seconds, so rtt is at least that
+        stats = self._get_stats(addr)
+        if stats.srtt is None:
+            stats.srtt = elapsed
+            stats.rttvar = elapsed / 2
+        elif elapsed > stats.srtt:
+            stats.rttvar = 0.75 * stats.rttvar + 0.25 * (elapsed - stats.srtt)
+            stats.srtt = 0.875 * stats.srtt + 0.125 * elapsed
+
+    def record_timeout(self, addr):
+        stats = self._get_stats(addr)
+        stats.failures += 1
+        backoff = min(2 ** stats.failures, InfraCache.MAX_BACKOFF)
+        stats.retry_at = time.monotonic() + backoff
+
+    def rank(self, addrs):
+        # responsive servers by rtt first, then backed off ones by retry time
+        now = time.monotonic()
+
+        def sort_key(addr):
+            stats = self.servers.get(addr)
+            if stats is None:
+                return (False, InfraCache.INITIAL_RTT, random.random())
+            if stats.retry_at > now:
+                return (True, stats.retry_at, 0)
+            srtt = stats.srtt if stats.srtt is not None else InfraCache.INITIAL_RTT
+            return (False, srtt, random.random())
+
+        return sorted(set(addrs), key=sort_key)
+
+    def _get_stats(self, addr):
+        stats = self.servers.get(addr)
+        if stats is None:
+            stats = ServerStats()
+            self.servers[addr] = stats
+        return stats
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, pool):
+        self.pool = pool
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.pool.dispatch(data, addr, self.transport)
+
+    def error_received(self, exc):
+        logger.warning('Upstream socket error %s', exc)
+
+
+class TcpConnection:
+    '''
+        Persistent TCP connection to upstream server. Queries are pipelined
+        and responses are matched to them in any order (RFC 7766).
+    '''
+    def __init__(self, loop, addr, reader, writer, idle_timeout):
+        self.loop = loop
+        self.addr = addr
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        # (query_id, addr, (name, tp, cl)) -> future
+        self.waiting = dict()
+        self.read_task = loop.create_task(self._read_responses(idle_timeout))
+
+    def send(self, key, query):
+        future = self.loop.create_future()
+        self.waiting[key] = future
+        self.writer.write(RDLEN.pack(len(query)) + query)
+        return future
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_result(None)
+        self.waiting.clear()
+
+    async def _read_responses(self, idle_timeout):
+        try:
+            while True:
+                try:
+                    length = await asyncio.wait_for(self.reader.readexactly(2), idle_timeout)
+                except asyncio.TimeoutError:
+                    if len(self.waiting) == 0:
+                        break
+                    continue
+                data = await self.reader.readexactly(RDLEN.unpack(length)[0])
+                response = decode_response(data)
+                if response is None:
+                    continue
+                future = self.waiting.pop(response_key(response, self.addr), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self.close()
+
+
+class UpstreamPool:
+    '''
+        Long-lived UDP sockets shared by all upstream queries.
+        Responses are dispatched to waiting futures by socket the query
+        was sent from, (transaction ID, server address, question).
+    '''
+    # unused TCP connections are closed after that many seconds
+    TCP_IDLE_TIMEOUT = 10
+
+    def __init__(self, loop, size=4, attempts=2, max_servers=3, fanout=1,
+            edns_payload=EDNS_PAYLOAD, max_queries=None, metrics=None):
+        self.loop = loop
+        self.size = size
+        # sends to one server, and servers tried per question
+        self.attempts = attempts
+        self.max_servers = max_servers
+        # servers queried in parallel, 1 disables racing
+        self.fanout = fanout
+        # UDP payload advertised to servers, None disables EDNS0
+        self.edns_payload = edns_payload
+        # queries waiting for response, and limit of them
+        self.active_queries = 0
+        self.max_queries = max_queries
+        self.shed_queries = 0
+        self.metrics = Metrics() if metrics is None else metrics
+        self.infra = InfraCache()
+        self.transports = []
+        # (transport, (query_id, addr, (name, tp, cl))) -> future
+        self.waiting = dict()
+        # addr -> TcpConnection, for truncated responses
+        self.tcp_connections = dict()
+
+    async def start(self):
+        for i in range(self.size):
+            transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: UpstreamProtocol(self), sock=make_upstream_socket())
+            self.transports.append(transport)
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+        for connection in self.tcp_connections.values():
+            connection.close()
+        self.tcp_connections = dict()
+
+    async def query_any(self, addrs, question):
+        # asks servers from the fastest one until some answers
+        if self.fanout > 1:
+            return await self.query_racing(addrs, question)
+
+        for addr in self.infra.rank(addrs)[:self.max_servers]:
+            response = await self.query(addr, question)
+            if response is not None:
+                return response
+        return None
+
+    async def query_racing(self, addrs, question):
+        # asks the next server too if the previous ones are late,
+        # first response wins and the rest queries are cancelled
+        queries = []
+        try:
+            for addr in self.infra.rank(addrs)[:max(self.fanout, self.max_servers)]:
+                if sum(1 for query in queries if not query.done()) >= self.fanout:
+                    # the next server is asked once any query ends
+                    response = await self._first_response(queries, None, any_done=True)
+                    if response is not None:
+                        return response
+
+                queries.append(self.loop.create_task(self.query(addr, question)))
+                response = await self._first_response(queries, self.infra.race_delay(addr))
+                if response is not None:
+                    return response
+
+            while any(not query.done() for query in queries):
+                response = await self._first_response(queries, None)
+                if response is not None:
+                    return response
+            return None
+        finally:
+            for query in queries:
+                query.cancel()
+
+    async def _first_response(self, queries, timeout, any_done=False):
+        # waits until some query gets response, all fail or timeout passes,
+        # with any_done until some query ends
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for query in queries:
+                if query.done() and query.result() is not None:
+                    return query.result()
+
+            pending = [query for query in queries if not query.done()]
+            if len(pending) == 0:
+                return None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return None
+
+            done, _ = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+                return None
+            if any_done and all(query.result() is None for query in done):
+                return None
+
+    async def query(self, addr, question):
+        # returns None if server did not answer or there are too many queries
+        if self.max_queries is not None and self.active_queries >= self.max_queries:
+            self.shed_queries += 1
+            return None
+
+        # retransmissions go from the same socket, responses are accepted only on it
+        transport = random.choice(self.transports)
+        key = (transport, query_key(random_query_id(), addr, question))
+        while key in self.waiting:
+            key = (transport, query_key(random_query_id(), addr, question))
+
+        future = self.loop.create_future()
+        self.waiting[key] = future
+        self.active_queries += 1
+        try:
+            query = construct_query_from_questions(
+                key[1][0], [question], self.edns_payload).to_bytes()
+            timeout = self.infra.timeout(addr)
+            first_sent_at = time.monotonic()
+            for attempt in range(self.attempts):
+                sent_at = time.monotonic()
+                transport.sendto(query, addr)
+                self.metrics.upstream_queries.inc('udp')
+                try:
+                    response = await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    timeout = min(timeout * 2, InfraCache.MAX_TIMEOUT)
+                    continue
+                except asyncio.CancelledError:
+                    # lost the race to another server
+                    self.infra.record_late(addr, time.monotonic() - first_sent_at)
+                    raise
+
+                # rtt of retransmitted query is ambiguous
+                rtt = time.monotonic() - sent_at if attempt == 0 else None
+                self.infra.record_response(addr, rtt)
+                if rtt is not None:
+                    self.metrics.upstream_latency.observe(rtt)
+                if response.trunc:
+                    # response did not fit into datagram, retry over TCP
+                    tcp_response = await self.query_tcp(addr, question)
+                    if tcp_response is not None:
+                        return tcp_response
+                return response
+
+            logger.debug('Timeout of %s:%s', *addr)
+            self.metrics.upstream_timeouts.inc()
+            self.infra.record_timeout(addr)
+            return None
+        finally:
+            del self.waiting[key]
+            self.active_queries -= 1
+
+    async def query_tcp(self, addr, question):
+        # returns None if server did not answer
+        connection = self.tcp_connections.get(addr)
+        if connection is None or connection.closed:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(*addr), InfraCache.MAX_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                logger.debug('TCP connection to %s:%s failed', *addr)
+                return None
+            connection = TcpConnection(
+                self.loop, addr, reader, writer, UpstreamPool.TCP_IDLE_TIMEOUT)
+            self.tcp_connections[addr] = connection
+
+        key = query_key(random_query_id(), addr, question)
+        while key in connection.waiting:
+            key = query_key(random_query_id(), addr, question)
+
+        query = construct_query_from_questions(
+            key[0], [question], self.edns_payload).to_bytes()
+        future = connection.send(key, query)
+        self.metrics.upstream_queries.inc('tcp')
+        sent_at = time.monotonic()
+        try:
+            response = await asyncio.wait_for(future, InfraCache.MAX_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.debug('TCP timeout of %s:%s', *addr)
+            self.metrics.upstream_timeouts.inc()
+            return None
+        else:
+            if response is not None:
+                self.metrics.upstream_latency.observe(time.monotonic() - sent_at)
+            return response
+        finally:
+            connection.waiting.pop(key, None)
+
+    def dispatch(self, data, addr, transport):
+        # malformed responses are dropped, so the query is retransmitted or times out
+        response = decode_response(data)
+        if response is None:
+            return
+        future = self.waiting.get((transport, response_key(response, addr)))
+        if future is not None and not future.done():
+            future.set_result(response)
@@ -0,0 +1,125 @@
+import heapq
+import struct
+import time
+from collections import OrderedDict
+from package_decode import find_ttl_offsets
+from caching import EXPIRING_FRACTION
+
+
+TTL = struct.Struct('!I')
+ID = struct.Struct('!H')
+# part of byte budget of records cache given to wire cache
+MAX_BYTES_SHARE = 0.25
+
+
+def get_max_bytes(cache_max_bytes):
+    if cache_max_bytes is None:
+        return None
+    return int(cache_max_bytes * MAX_BYTES_SHARE)
+
+
+class WireCacheItem:
+    __slots__ = ('response', 'ttl_offsets', 'ttls', 'stored_at', 'expires_at', 'hits')
+
+    def __init__(self, response, ttl_offsets, ttls, stored_at, hits=0):
+        self.response = response
+        self.ttl_offsets = ttl_offsets
+        self.ttls = ttls
+        self.stored_at = stored_at
+        self.expires_at = stored_at + min(ttls)
+        self.hits = hits
+
+
+class WireCache:
+    '''
+        Keeps fully encoded responses by (qname, qtype, qclass).
+        A hit only patches transaction ID and TTL fields of a copy,
+        without decoding or encoding any records.
+    '''
+    # rough size of key, item and TTL tables, used for max_bytes
+    ITEM_OVERHEAD = 300
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        # keys are kept in least recently used order
+        self.cache = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # (expires_at, key) for proactive removal of expired responses
+        self.expiry_heap = []
+        self.size_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        # called with key and its hits when response is hit close to expiry
+        self.on_expiring = None
+
+    def add_response(self, question, response):
+        ttl_offsets = find_ttl_offsets(response)
+        if len(ttl_offsets) == 0:
+            return
+
+        ttls = tuple(TTL.unpack_from(response, offset)[0] for offset in ttl_offsets)
+        key = (question.name, question.tp, question.cl)
+        now = time.monotonic()
+        self._remove_expired(now)
+        # refreshed response keeps popularity of replaced one
+        old_item = self.cache.pop(key, None)
+        if old_item is not None:
+            self.size_bytes -= self._item_size(key, old_item)
+        item = WireCacheItem(bytes(response), ttl_offsets, ttls,
+            now, 0 if old_item is None else old_item.hits)
+        self.cache[key] = item
+        self.size_bytes += self._item_size(key, item)
+        heapq.heappush(self.expiry_heap, (item.expires_at, key))
+
+        while len(self.cache) > 0 and (
+                self.max_entries is not None and len(self.cache) > self.max_entries
+                or self.max_bytes is not None and self.size_bytes > self.max_bytes):
+            evicted_key, evicted = self.cache.popitem(last=False)
+            self.size_bytes -= self._item_size(evicted_key, evicted)
+            self.evictions += 1
+
+    def _remove_expired(self, now):
+        heap = self.expiry_heap
+        while len(heap) > 0 and heap[0][0] <= now:
+            expires_at, key = heapq.heappop(heap)
+            item = self.cache.get(key)
+            # heap keeps entries of replaced and evicted responses
+            if item is not None and item.expires_at == expires_at:
+                self._remove(key, item)
+                self.expirations += 1
+
+        if len(heap) > 2 * len(self.cache) + 64:
+            self.expiry_heap = [(item.expires_at, key) for key, item in self.cache.items()]
+            heapq.heapify(self.expiry_heap)
+
+    def _remove(self, key, item):
+        del self.cache[key]
+        self.size_bytes -= self._item_size(key, item)
+
+    def _item_size(self, key, item):
+        return len(key[0]) + len(item.response) + WireCache.ITEM_OVERHEAD
+
+    def find_response(self, query_id, question):
+        key = (question.name, question.tp, question.cl)
+        item = self.cache.get(key)
+        if item is None:
+            return None
+
+        now = time.monotonic()
+        if now >= item.expires_at:
+            self._remove(key, item)
+            self.expirations += 1
+            return None
+
+        self.cache.move_to_end(key)
+        if self.on_expiring is not None:
+            item.hits += 1
+            if item.expires_at - now < EXPIRING_FRACTION * (item.expires_at - item.stored_at):
+                self.on_expiring(key, item.hits)
+        response = bytearray(item.response)
+        ID.pack_into(response, 0, query_id)
+        elapsed = int(now - item.stored_at)
+        if elapsed > 0:
+            for offset, ttl in zip(item.ttl_offsets, item.ttls):
+                TTL.pack_into(response, offset, ttl - elapsed)
+        return response
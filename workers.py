@@ -0,0 +1,116 @@
+import glob
+import logging
+import os
+import signal
+import time
+from caching import BinaryCacheManager, get_cache_manager
+
+logger = logging.getLogger(__name__)
+
+
+def raise_interrupt(signum, frame):
+    # next signals are ignored while shutting down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+class WorkerSupervisor:
+    '''
+        Forks worker processes, restarts the crashed ones
+        and merges their caches into one snapshot on shutdown.
+    '''
+    # pause before restart of crashed worker
+    RESTART_DELAY = 1
+
+    def __init__(self, workers, serve_worker, make_cache, save,
+            cache_manager=BinaryCacheManager):
+        self.workers = workers
+        # called in worker with file name to save its cache in
+        # and list of files with its cache saved before
+        self.serve_worker = serve_worker
+        # makes cache to merge workers caches into
+        self.make_cache = make_cache
+        self.save = save
+        self.cache_manager = cache_manager
+        # pid -> worker index
+        self.pids = dict()
+
+    def part_file(self, index):
+        return '{0}.worker{1}'.format(self.save, index)
+
+    def part_files(self):
+        # index -> existing part files, parts left by more workers are shared round robin
+        prefix = self.part_file('')
+        parts = dict()
+        for file_name in sorted(glob.glob(glob.escape(prefix) + '*')):
+            suffix = file_name[len(prefix):]
+            if suffix.isdigit():
+                parts.setdefault(int(suffix) % self.workers, []).append(file_name)
+        return parts
+
+    def run(self):
+        signal.signal(signal.SIGTERM, raise_interrupt)
+        try:
+            for index in range(self.workers):
+                self._start_worker(index)
+
+            while True:
+                pid, status = os.wait()
+                index = self.pids.pop(pid, None)
+                if index is None:
+                    continue
+                logger.warning('Worker %s exited with status %s, restarting', index, status)
+                time.sleep(WorkerSupervisor.RESTART_DELAY)
+                self._start_worker(index)
+        except KeyboardInterrupt:
+            logger.info('Server shutdown')
+        finally:
+            self._stop_workers()
+            self._merge_caches()
+
+    def _start_worker(self, index):
+        pid = os.fork()
+        if pid != 0:
+            self.pids[pid] = index
+            return
+
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, raise_interrupt)
+            signal.signal(signal.SIGTERM, raise_interrupt)
+            # caches saved before crash or restart are loaded back
+            self.serve_worker(self.part_file(index), self.part_files().get(index, []))
+        except BaseException:
+            logger.exception('Worker %s failed', index)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _stop_workers(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        while len(self.pids) > 0:
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                break
+            self.pids.pop(pid, None)
+
+    def _merge_caches(self):
+        cache = self.make_cache()
+        part_files = [file_name for parts in self.part_files().values() for file_name in parts]
+        for part_file in part_files:
+            get_cache_manager(part_file).load_cache_from(part_file, cache)
+
+        # parts are removed only when merged snapshot is in place
+        temp_file_name = '{}.tmp'.format(self.save)
+        self.cache_manager.save_cache_to(cache, temp_file_name)
+        os.replace(temp_file_name, self.save)
+        for part_file in part_files:
+            os.remove(part_file)